@@ -0,0 +1,128 @@
+"""Batch simulation of many Snek Is You games on the same level"""
+
+import numpy as np
+
+import lab
+
+DIRECTIONS = ("up", "down", "left", "right")
+
+
+class BatchGame:
+    '''
+    N games of the same level, all advanced at once by step with one
+    direction per game.
+
+    Games in the same state share a single Board (compared by Zobrist hash,
+    then cell by cell), which is only stepped once per distinct direction
+    taken from it, so the cost of a tick depends on the number of distinct
+    (state, direction) pairs rather than on N. The state of game i is
+    boards[i]; boards must never be stepped directly since they are shared.
+
+    Per-game results are NumPy arrays:
+        - won: True once the game was won
+        - defeated: True once the game has no YOU object left (and wasn't won)
+        - steps: number of steps taken (finished games don't take any more)
+    '''
+    def __init__(self, level_description, n, new_game=lab.new_game):
+        board = new_game(level_description)
+        self.boards = [board] * n
+        self.won = np.zeros(n, dtype=bool)
+        self.defeated = np.zeros(n, dtype=bool)
+        self.steps = np.zeros(n, dtype=np.int64)
+
+
+    def __len__(self):
+        return len(self.boards)
+
+
+    @property
+    def active(self):
+        '''
+        Boolean array of the games that are neither won nor defeated.
+        '''
+        return ~(self.won | self.defeated)
+
+
+    def step(self, directions):
+        '''
+        Advance every active game i by one step in directions[i]: a direction
+        name, an index into DIRECTIONS, or None (or a negative index) to leave
+        game i as it is. Returns the won array.
+        '''
+        if len(directions) != len(self.boards):
+            raise ValueError(f"expected {len(self.boards)} directions, got {len(directions)}")
+
+        # group the games to step by (shared board, direction)
+        groups = {}
+        active = self.active
+        for i, direction in enumerate(directions):
+            if isinstance(direction, (int, np.integer)):
+                direction = DIRECTIONS[direction] if direction >= 0 else None
+            if direction is not None and active[i]:
+                groups.setdefault((id(self.boards[i]), direction), []).append(i)
+
+        # a board taken in more than one direction (or also left as it is by
+        # some game) is copied for all of them, otherwise it is stepped in place
+        uses = {}
+        for board in self.boards:
+            uses[id(board)] = uses.get(id(board), 0) + 1
+
+        stepped = {}    # maps a state hash to the boards stepped into that state
+        for (_, direction), indices in groups.items():
+            board = self.boards[indices[0]]
+            if uses[id(board)] > len(indices):
+                uses[id(board)] -= len(indices)
+                board = board.copy()
+            victory = lab.step_game(board, direction)
+
+            # share the board with the games that got to the same state another way
+            for other in stepped.setdefault(board.state_hash(), []):
+                if other.level_description == board.level_description:
+                    board = other
+                    break
+            else:
+                stepped[board.state_hash()].append(board)
+
+            for i in indices:
+                self.boards[i] = board
+            self.steps[indices] += 1
+            if victory:
+                self.won[indices] = True
+            elif not board.has_you(lab.parse_rules(board)[0]):
+                self.defeated[indices] = True
+        return self.won
+
+
+    def run(self, moves):
+        '''
+        Step the games through moves, a sequence of ticks (each a sequence of
+        N directions, see step), or a 2D array of direction indices with one
+        row per tick. Stops early once every game is finished. Returns the
+        won array.
+        '''
+        for directions in moves:
+            if not self.active.any():
+                break
+            self.step(directions)
+        return self.won
+
+
+    def state_hashes(self):
+        '''
+        Return an array of the Zobrist hash of every game's state.
+        '''
+        return np.array([board.state_hash() for board in self.boards], dtype=np.uint64)
+
+
+    def distinct_states(self):
+        '''
+        Return the number of Boards actually held for the N games.
+        '''
+        return len({id(board) for board in self.boards})
+
+
+    def dump_game(self, i):
+        '''
+        Return the level description of game i, as lab.dump_game would.
+        '''
+        return lab.dump_game(self.boards[i])
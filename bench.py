@@ -0,0 +1,148 @@
+"""Benchmarks for the Snek Is You step engine"""
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import importlib
+import tracemalloc
+
+import lab
+import server
+
+DIRECTIONS = ("up", "down", "left", "right")
+
+
+def tile_level(level_description, rows, cols):
+    """
+    Return a rows x cols level made by repeating level_description in both
+    directions.
+    """
+    height, width = len(level_description), len(level_description[0])
+    return [
+        [list(level_description[x % height][y % width]) for y in range(cols)]
+        for x in range(rows)
+    ]
+
+
+def get_scenarios(sizes, steps, seed=6009):
+    """
+    Return a list of (name, level description, directions) to benchmark: the
+    recorded input script of every test level, then puzzles/computer_maze.txt
+    tiled to each size x size in sizes, stepped steps times in random
+    directions.
+    """
+    scenarios = []
+    for fname in sorted(os.listdir(os.path.join(server.LOCATION, "test_levels"))):
+        name = fname.rsplit(".", 1)[0]
+        level = server.read_level(os.path.join(server.LOCATION, "test_levels", fname))
+        with open(os.path.join(server.LOCATION, "test_inputs", f"{name}.txt")) as f:
+            directions = f.read().strip().splitlines(False)
+        scenarios.append((name, level, directions))
+
+    maze = server.read_level(os.path.join(server.LOCATION, "puzzles", "computer_maze.txt"))
+    rng = random.Random(seed)
+    for size in sizes:
+        directions = [rng.choice(DIRECTIONS) for _ in range(steps)]
+        scenarios.append((f"computer_maze_{size}x{size}", tile_level(maze, size, size), directions))
+    return scenarios
+
+
+def run_scenario(new_game, level_description, directions, memory=True):
+    """
+    Play directions on a new game and return a dict of measurements: seconds
+    for new_game and for all the steps, steps per second, seconds per phase
+    and events (see lab.Stats), and (if memory is True) the peak memory in
+    bytes traced while doing all that again with tracemalloc, which is too
+    slow to time at the same time.
+    """
+    start = time.perf_counter()
+    game = new_game(level_description)
+    setup = time.perf_counter() - start
+
+    game.stats = lab.Stats()
+    start = time.perf_counter()
+    for direction in directions:
+        lab.step_game(game, direction)
+    seconds = time.perf_counter() - start
+
+    result = {
+        "rows": len(level_description),
+        "cols": len(level_description[0]),
+        "steps": len(directions),
+        "setup_seconds": setup,
+        "seconds": seconds,
+        "steps_per_second": len(directions) / max(seconds, 1e-9),
+        "phases": game.stats.seconds,
+        "events": game.stats.as_dict()["events"],
+        "state_hash": game.state_hash(),  # to tell apart runs that don't end alike
+    }
+
+    if memory:
+        del game
+        tracemalloc.start()
+        try:
+            game = new_game(level_description)
+            for direction in directions:
+                lab.step_game(game, direction)
+            result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def compare(results, baseline):
+    """
+    Return lines comparing the steps per second of results against those of a
+    baseline (both as saved by this script), for the benchmarks in both.
+    """
+    old = {result["name"]: result for result in baseline["results"]}
+    lines = []
+    for result in results["results"]:
+        if result["name"] in old:
+            ratio = result["steps_per_second"] / max(old[result["name"]]["steps_per_second"], 1e-9)
+            lines.append(f"{result['name']}: {ratio:.2f}x the steps/s of the baseline")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--engine", default="lab", help="module providing new_game (e.g. bitboard)")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[100, 1000], help="sizes of the tiled computer_maze boards")
+    parser.add_argument("--steps", type=int, default=20, help="steps taken on each tiled board")
+    parser.add_argument("--filter", default="", help="only run the benchmarks whose name contains this")
+    parser.add_argument("--no-memory", action="store_true", help="skip the (slow) peak memory measurement")
+    parser.add_argument("--output", help="save the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parsed = parser.parse_args()
+
+    new_game = importlib.import_module(parsed.engine).new_game
+    results = {
+        "engine": parsed.engine,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": [],
+    }
+
+    for name, level, directions in get_scenarios(parsed.sizes, parsed.steps):
+        if parsed.filter not in name:
+            continue
+        result = {"name": name, **run_scenario(new_game, level, directions, not parsed.no_memory)}
+        results["results"].append(result)
+
+        phases = ", ".join(f"{phase} {seconds * 1000:.1f}ms" for phase, seconds in result["phases"].items())
+        memory = f", peak {result['peak_memory_bytes'] / 2**20:.1f} MiB" if "peak_memory_bytes" in result else ""
+        print(f"{name}: {result['steps_per_second']:.0f} steps/s ({phases}){memory}")
+        sys.stdout.flush()
+
+    if parsed.output:
+        with open(parsed.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if parsed.compare:
+        with open(parsed.compare) as f:
+            for line in compare(results, json.load(f)):
+                print(line)
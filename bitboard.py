@@ -0,0 +1,162 @@
+"""NumPy bit-plane Board engine for Snek Is You"""
+
+import numpy as np
+
+import lab
+
+
+# Count planes hold up to this many copies of an object in one cell
+COUNT_MAX = np.iinfo(np.uint16).max
+
+
+class BitBoard(lab.Board):
+    '''
+    Board that keeps, next to the object index of lab.Board, a stack of NumPy
+    count planes, one per object token (see lab.get_token), and a plane of
+    the phrase code of every cell (see get_phrase_codes), all updated one cell
+    at a time as objects are added and removed. WIN/DEFEAT/YOU overlap is
+    then a gather from the planes at the YOU cells, and phrase detection
+    reads the codes of the dirty lines, so that the work done on each step
+    depends on the objects that move rather than on the area of the board.
+
+    The cell lists in level_description are kept alongside the planes because
+    pushing and pulling depend on the order of the objects within a cell.
+    '''
+    def build_index(self):
+        '''
+        Build the object index (see lab.Board.build_index) and the planes:
+        planes[t, x, y] counts the objects with token t at location (x,y),
+        codes[x, y] is the phrase code of the cell at location (x,y).
+        '''
+        self.planes = np.zeros((len(lab.token_names), self.rows, self.cols), dtype=np.uint16)
+        self.codes = np.full((self.rows, self.cols), -1, dtype=np.int32)
+        super().build_index()
+
+
+    def copy_index(self):
+        '''
+        Helper function for copy. Replace the object index and the planes
+        (shared with the BitBoard this one was copied from) by copies of them.
+        '''
+        super().copy_index()
+        self.planes = self.planes.copy()
+        self.codes = self.codes.copy()
+
+
+    def index_add(self, obj, location):
+        '''
+        Record one more obj (token) at location (tuple (x,y)) in the object
+        index and the planes, once it was added to its cell.
+        '''
+        super().index_add(obj, location)
+        x, y = location
+        if self.planes[obj, x, y] == COUNT_MAX:
+            raise OverflowError(f"more than {COUNT_MAX} {lab.get_name(obj)} objects at location {location}")
+        self.planes[obj, x, y] += 1
+        self.codes[x, y] = get_phrase_code(self.level_description[x][y])
+
+
+    def index_remove(self, obj, location):
+        '''
+        Record one less obj (token) at location (tuple (x,y)) in the object
+        index and the planes, once it was removed from its cell.
+        '''
+        super().index_remove(obj, location)
+        x, y = location
+        self.planes[obj, x, y] -= 1
+        self.codes[x, y] = get_phrase_code(self.level_description[x][y])
+
+
+    def get_overlap(self, cells, objs):
+        '''
+        Return the list of the locations among cells (iterable of tuples (x,y))
+        that contain at least one of the given objs (iterable of tokens), by
+        gathering the planes of objs at cells.
+        '''
+        tokens = [obj for obj in objs if obj < len(self.planes)]
+        cells = list(cells)
+        if not tokens or not cells:
+            return []
+        xs, ys = np.array(cells).T
+        found = self.planes[np.array(tokens)[:, None], xs, ys].any(axis=0)
+        return [cell for cell, hit in zip(cells, found.tolist()) if hit]
+
+
+    def is_defeat(self, property_rules):
+        '''
+        Eliminate all YOU objects that land on a square where an object has
+        property DEFEAT.
+        '''
+        property_rules = lab.compile_rules(property_rules)
+        you_objs = property_rules.you_objs
+
+        # only the YOU squares that also hold a DEFEAT object change
+        for location in self.get_overlap(self.get_cells_with(you_objs), property_rules.defeat_objs):
+            x, y = location
+            square = self.level_description[x][y]
+            for obj in [obj for obj in square if obj in you_objs]:
+                self.remove_obj(obj, location)
+
+
+    def is_win(self, property_rules):
+        '''
+        Return True if a YOU object lands on a square that contains an object
+        with a WIN property. Else returns False.
+        '''
+        property_rules = lab.compile_rules(property_rules)
+        you_cells = self.get_cells_with(property_rules.you_objs)
+        return bool(self.get_overlap(you_cells, property_rules.win_objs))
+
+
+    def get_phrase_codes(self):
+        '''
+        Return the (rows, cols) int array of what each cell contributes to a
+        phrase (see get_phrase_code). It is kept up to date, so it must not be
+        modified.
+        '''
+        return self.codes
+
+
+    def get_code_phrases(self, codes):
+        '''
+        Return the list of possible phrases in one line of phrase codes (as
+        returned from get_phrase_codes), or [] if it has no "IS" word.
+        '''
+        codes = codes.tolist()
+        if lab.IS_TOKEN not in codes:
+            return []
+        return lab.get_token_phrases(None if code == -1 else code for code in codes)
+
+
+    def get_phrases(self):
+        '''
+        Return the list of unique possible phrases on the board (horizontal ones
+        first, then vertical ones), re-scanning only the rows and columns marked
+        dirty, and skipping any line without an "IS" word.
+        '''
+        for i, phrases in enumerate(self.row_phrases):
+            if phrases is None:
+                self.row_phrases[i] = self.get_code_phrases(self.codes[i])
+
+        for j, phrases in enumerate(self.col_phrases):
+            if phrases is None:
+                self.col_phrases[j] = self.get_code_phrases(self.codes[:, j])
+
+        return lab.merge_phrases(self.row_phrases) + lab.merge_phrases(self.col_phrases)
+
+
+def get_phrase_code(cell):
+    '''
+    Return what cell (list of tokens) contributes to a phrase as an int: -1
+    if it is empty, else lab.get_phrase_token of it (a word's token, or 0).
+    '''
+    token = lab.get_phrase_token(cell)
+    return -1 if token is None else token
+
+
+def new_game(level_description):
+    """
+    Given a description of a game state, create and return a BitBoard instance
+    that contains level_description (see lab.new_game).
+    """
+    return BitBoard(lab.encode_level(level_description))
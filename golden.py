@@ -0,0 +1,130 @@
+"""Compact golden outputs for Snek Is You: per-step cell changes and state hashes"""
+
+import os
+import json
+import argparse
+
+import lab
+import replay
+
+FORMAT = "snek-golden"
+VERSION = 1
+EXTENSION = ".golden"  # next to the JSON goldens in test_outputs (.golden.gz works too)
+
+
+def find_golden(directory, name):
+    """
+    Return the path of the compact golden of the test name in directory,
+    compressed (EXTENSION + ".gz") or not, or None if it has none.
+    """
+    for extension in (EXTENSION, EXTENSION + ".gz"):
+        path = os.path.join(directory, name + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def get_records(level_description, outputs):
+    """
+    Generate the records of the compact golden of level_description, given
+    its JSON golden outputs (a list of [board, victory] after each step): a
+    header, then for each step the victory, the cells that changed as
+    [row, col, objects], and the state hash of the board (as 16 hex digits).
+    """
+    yield {"format": FORMAT, "version": VERSION, "steps": len(outputs)}
+    previous = level_description
+    for board, victory in outputs:
+        changes = [
+            [x, y, cell]
+            for x, row in enumerate(board)
+            for y, cell in enumerate(row)
+            if cell != previous[x][y]
+        ]
+        state_hash = lab.new_game(board).state_hash()
+        yield {"victory": victory, "changes": changes, "hash": f"{state_hash:016x}"}
+        previous = board
+
+
+def write_golden(path, level_description, outputs):
+    """
+    Save the compact golden of level_description and its JSON golden outputs
+    (see get_records) to the file at path, one JSON record per line.
+    """
+    with replay.open_file(path, "w") as f:
+        for record in get_records(level_description, outputs):
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+def read_golden(path):
+    """
+    Generate the records of the compact golden stored in the file at path,
+    reading it one line at a time.
+    """
+    with replay.open_file(path, "r") as f:
+        header = json.loads(next(f))
+        if header.get("format") != FORMAT or header.get("version") != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} {FORMAT} file")
+        yield header
+        for line in f:
+            yield json.loads(line)
+
+
+def compare_golden(game, directions, records, flip=False):
+    """
+    Step game (a new game of the golden's level) through directions, checking
+    each step against the next record of a compact golden (as generated by
+    read_golden) and raising an AssertionError at the first mismatch.  If
+    flip is True, game is the level with rows and columns swapped, so the
+    golden's cells are too and its hashes can't be checked.
+
+    Only the cells changed by either the game or the golden are compared
+    (ignoring the order of objects), so each step costs as much as the
+    changes it makes.  Returns the number of steps checked.
+    """
+    records = iter(records)
+    header = next(records)
+    expected = lab.dump_game(game)
+    lab.dump_changes(game)
+
+    steps = 0
+    for direction, record in zip(directions, records):
+        steps += 1
+        victory = lab.step_game(game, direction)
+        assert victory == record["victory"], f"victory doesn't match on step {steps}"
+
+        locations = set()
+        for x, y, cell in record["changes"]:
+            if flip:
+                x, y = y, x
+            expected[x][y] = cell
+            locations.add((x, y))
+        for x, y, cell in lab.dump_changes(game):
+            locations.add((x, y))
+        for x, y in sorted(locations):
+            actual = [lab.get_name(obj) for obj in game.level_description[x][y]]
+            assert sorted(actual) == sorted(expected[x][y]), f"objects at location ({x},{y}) don't match on step {steps}"
+
+        if not flip:
+            assert f"{game.state_hash():016x}" == record["hash"], f"state hash doesn't match on step {steps}"
+    assert steps == header["steps"], f"golden has {header['steps']} steps, got {steps}"
+    return steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert JSON goldens in test_outputs to the compact format")
+    parser.add_argument("names", nargs="*", help="test names (default: every test level)")
+    parser.add_argument("--gzip", action="store_true", help="compress the compact goldens")
+    parsed = parser.parse_args()
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    names = parsed.names or sorted(
+        fname.rsplit(".", 1)[0] for fname in os.listdir(os.path.join(directory, "test_levels"))
+    )
+    for name in names:
+        with open(os.path.join(directory, "test_levels", f"{name}.json")) as f:
+            level = json.load(f)
+        with open(os.path.join(directory, "test_outputs", f"{name}.json")) as f:
+            outputs = json.load(f)
+        path = os.path.join(directory, "test_outputs", name + EXTENSION + (".gz" if parsed.gzip else ""))
+        write_golden(path, level, outputs)
+        print(f"{name}: {os.path.getsize(os.path.join(directory, 'test_outputs', f'{name}.json'))} -> {os.path.getsize(path)} bytes")
@@ -0,0 +1,126 @@
+"""Distance fields to the WIN cells of Snek Is You boards, for hints"""
+
+import threading
+import collections
+
+import lab
+
+FIELD_CACHE_SIZE = 256  # distance fields kept (least recently used ones are dropped)
+FIELD_CACHE = collections.OrderedDict()  # maps a layout key (see get_layout_key) to its distances
+FIELD_CACHE_LOCK = threading.Lock()
+
+
+def get_wall_objs(property_rules):
+    """
+    Return the frozenset of the objects (tokens) that are walls under
+    property_rules: STOP but not also PUSH (which could be pushed out of the
+    way) or YOU (which moves every step).
+    """
+    return property_rules.stop_objs - frozenset(property_rules.you_objs)
+
+
+def get_layout_key(game, property_rules):
+    """
+    Return the key of the static layout of game under property_rules: its
+    size, which objects are walls and WIN, and the Zobrist hashes of where
+    those are (see lab.Board.objects_hash), which the board keeps up to date
+    as objects move, so getting the key doesn't depend on the board's size.
+    """
+    wall_objs = get_wall_objs(property_rules)
+    win_objs = frozenset(property_rules.win_objs)
+    return (
+        game.rows,
+        game.cols,
+        wall_objs,
+        win_objs,
+        game.objects_hash(wall_objs),
+        game.objects_hash(win_objs),
+    )
+
+
+def get_layout(game, property_rules):
+    """
+    Return the static layout of game under property_rules: (rows, cols, set
+    of wall cells, set of WIN cells), see get_wall_objs.
+    """
+    walls = game.get_cells_with(get_wall_objs(property_rules))
+    wins = game.get_cells_with(property_rules.win_objs)
+    return (game.rows, game.cols, walls - wins, wins)
+
+
+def compute_distances(layout):
+    """
+    Return the distance field of layout (see get_layout): a flat row-major
+    list of the number of moves from each cell to the closest WIN cell,
+    going around the walls, or -1 where no WIN cell can be reached.  It is a
+    breadth-first search from all the WIN cells at once.
+    """
+    rows, cols, walls, wins = layout
+    distances = [-1] * (rows * cols)
+    frontier = collections.deque()
+    for x, y in wins:
+        distances[x * cols + y] = 0
+        frontier.append((x, y))
+
+    while frontier:
+        x, y = frontier.popleft()
+        distance = distances[x * cols + y] + 1
+        for dx, dy in lab.direction_vector.values():
+            new_x, new_y = x + dx, y + dy
+            if 0 <= new_x < rows and 0 <= new_y < cols and (new_x, new_y) not in walls:
+                if distances[new_x * cols + new_y] == -1:
+                    distances[new_x * cols + new_y] = distance
+                    frontier.append((new_x, new_y))
+    return distances
+
+
+def get_distances(game, property_rules=None):
+    """
+    Return the distance field (see compute_distances) of game under
+    property_rules (default: the current rules of game).  Fields are cached by
+    layout key (see get_layout_key), so they are only computed again when a
+    rule changes which objects are STOP or WIN, or when such objects move.
+    """
+    if property_rules is None:
+        property_rules = lab.parse_rules(game)[0]
+    key = get_layout_key(game, property_rules)
+    with FIELD_CACHE_LOCK:
+        distances = FIELD_CACHE.get(key)
+        if distances is not None:
+            FIELD_CACHE.move_to_end(key)
+            return distances
+
+    distances = compute_distances(get_layout(game, property_rules))
+    with FIELD_CACHE_LOCK:
+        FIELD_CACHE[key] = distances
+        while len(FIELD_CACHE) > FIELD_CACHE_SIZE:
+            FIELD_CACHE.popitem(last=False)
+    return distances
+
+
+def get_hints(game):
+    """
+    Return a list with a hint for every YOU object of game (by name, then
+    location): a dict with its "object" name, its "location" [x, y], its
+    "distance" in moves to the closest WIN cell (-1 if none can be reached)
+    and the "direction" of the next move along the way (None if it is already
+    there or can't get there).
+    """
+    property_rules = lab.parse_rules(game)[0]
+    distances = get_distances(game, property_rules)
+    rows, cols = game.rows, game.cols
+
+    hints = []
+    for you in sorted(property_rules.you_objs, key=lab.get_name):
+        for x, y in sorted(set(game.get_locations(you))):
+            # from the neighbors rather than the cell itself, which may be a wall
+            distance, best = (0, None) if distances[x * cols + y] == 0 else (-1, None)
+            if distance != 0:
+                for direction, (dx, dy) in lab.direction_vector.items():
+                    new_x, new_y = x + dx, y + dy
+                    if 0 <= new_x < rows and 0 <= new_y < cols:
+                        neighbor = distances[new_x * cols + new_y]
+                        if neighbor != -1 and (distance == -1 or neighbor + 1 < distance):
+                            distance, best = neighbor + 1, direction
+            hints.append({"object": lab.get_name(you), "location": [x, y], "distance": distance, "direction": best})
+    return hints
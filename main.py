@@ -1,12 +1,28 @@
 """Snek Is You Video Game"""
 
+import copy
+import time
+import zlib
 import doctest
+import threading
+import collections
 
 # Words with graphics
 NOUNS = {"SNEK", "FLAG", "ROCK", "WALL", "COMPUTER", "BUG"}
 PROPERTIES = {"YOU", "WIN", "STOP", "PUSH", "DEFEAT", "PULL"}
 WORDS = NOUNS | PROPERTIES | {"AND", "IS"}
 
+# Bit assigned to each property in compiled rules (see PropertyRules)
+YOU_BIT, WIN_BIT, STOP_BIT, PUSH_BIT, DEFEAT_BIT, PULL_BIT = 1, 2, 4, 8, 16, 32
+PROPERTY_BITS = {
+    "YOU": YOU_BIT,
+    "WIN": WIN_BIT,
+    "STOP": STOP_BIT,
+    "PUSH": PUSH_BIT,
+    "DEFEAT": DEFEAT_BIT,
+    "PULL": PULL_BIT,
+}
+
 # Maps a keyboard direction to a (delta_row, delta_column) vector.
 direction_vector = {
     "up": (-1, 0),
@@ -15,38 +31,188 @@ direction_vector = {
     "right": (0, +1),
 }
 
+# Interned object tokens: Board cells hold small ints instead of strs. A text
+# object (UPPERCASE) has the token of its graphical object with TEXT_FLAG set.
+TEXT_FLAG = 1
+token_names = []    # maps a token to its str
+token_ids = {}      # maps a str to its token
+token_lock = threading.Lock()   # serializes interning new strs
 
-def get_phrases(level_description):
+
+def get_token(obj):
     '''
-    Helper function for parse_rules. Given level_description (2D array), return
-    a list of unique possible phrases satisfying the following conditions:
-        - contains at least 3 words
-        - contains "IS"
+    Return the token for obj (str), interning it (along with its text or
+    graphical counterpart) if it hasn't been seen before. Tokens are returned
+    unchanged.
     '''
-    all_phrases = []
+    token = token_ids.get(obj)
+    if token is not None:
+        return token
+    if isinstance(obj, int):
+        return obj
     
-    # parse horizontally
-    for row in level_description:
-        temp_phrase = []
-        for obj in row:
-            if len(obj) == 1 and obj[0] in WORDS:
-                temp_phrase.append(obj[0])
-            elif len(obj) == 0:
-                if (len(temp_phrase) >= 3) and (temp_phrase not in all_phrases) and ("IS" in temp_phrase):
-                    all_phrases.append(temp_phrase)
-                temp_phrase = []
-        
-        # append if reached the end of a row
-        if (len(temp_phrase) >= 3) and (temp_phrase not in all_phrases) and ("IS" in temp_phrase):
-            all_phrases.append(temp_phrase)
+    with token_lock:
+        if obj in token_ids:    # interned by another thread in the meantime
+            return token_ids[obj]
         
+        # pair a graphical object (even token) with its text (odd token)
+        if obj.isupper():
+            pair = (obj.lower(), obj)
+        else:
+            pair = (obj, obj.upper())
+        if (pair[0] == pair[1] or pair[0] in token_ids or pair[1] in token_ids
+                or pair[0].upper() != pair[1] or pair[1].lower() != pair[0]):
+            # no usable counterpart, so only intern obj itself
+            pair = (None, obj) if obj.isupper() else (obj, None)
         
+        for name in pair:
+            if name is not None:
+                token_ids[name] = len(token_names)
+            token_names.append(name)
+        return token_ids[obj]
+
+
+def get_name(token):
+    '''
+    Return the str for the given token.
+    '''
+    return token_names[token]
+
+
+# Zobrist keys: one random-looking 64-bit int per (x, y, token, k), where k
+# counts earlier copies of the same object in the cell. Keys are derived from
+# the object's str, so hashes agree between processes.
+MASK_64 = (1 << 64) - 1
+zobrist_keys = {}
+
+
+def splitmix64(value):
+    '''
+    Return a well-mixed 64-bit int derived from value (int).
+    '''
+    value = (value + 0x9E3779B97F4A7C15) & MASK_64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return value ^ (value >> 31)
+
+
+def get_zobrist_key(x, y, obj, k):
+    '''
+    Return the Zobrist key for the k-th copy (from 0) of obj (token) in the
+    cell at location (x,y).
+    '''
+    key = zobrist_keys.get((x, y, obj, k))
+    if key is None:
+        key = splitmix64(zlib.crc32(token_names[obj].encode("utf-8")))
+        for value in (x, y, k):
+            key = splitmix64(key ^ value)
+        zobrist_keys[(x, y, obj, k)] = key
+    return key
+
+
+def encode_level(level_description):
+    '''
+    Return a copy of level_description (list of lists of lists of strs) with
+    every object replaced by its token.
+    '''
+    return [[[get_token(obj) for obj in cell] for cell in row] for row in level_description]
+
+
+def decode_level(level_description):
+    '''
+    Return a copy of level_description (list of lists of lists of tokens) with
+    every token replaced by its str.
+    '''
+    return [[[token_names[obj] for obj in cell] for cell in row] for row in level_description]
+
+
+# Tokens of the words with graphics, interned in a fixed order
+for word in sorted(WORDS):
+    get_token(word)
+NOUN_TOKENS = frozenset(get_token(word) for word in NOUNS)
+PROPERTY_TOKENS = frozenset(get_token(word) for word in PROPERTIES)
+WORD_TOKENS = frozenset(get_token(word) for word in WORDS)
+AND_TOKEN = get_token("AND")
+IS_TOKEN = get_token("IS")
+PROPERTY_TOKEN_BITS = {get_token(word): bit for word, bit in PROPERTY_BITS.items()}
+
+
+def get_phrase_token(cell):
+    '''
+    Helper function for get_phrases. Given a cell (list of tokens), return
+    what it contributes to a phrase:
+        - the word (token) itself if the cell holds exactly one word
+        - None if the cell is empty (breaks the phrase)
+        - 0 otherwise (the cell is skipped over)
+    '''
+    if len(cell) == 1 and cell[0] in WORD_TOKENS:
+        return cell[0]
+    elif len(cell) == 0:
+        return None
+    return 0
+
+
+def get_line_phrases(line):
+    '''
+    Helper function for get_phrases. Given a single row or column of cells,
+    return a list of the possible phrases in it, in order of appearance.
+    '''
+    return get_token_phrases(get_phrase_token(obj) for obj in line)
+
+
+def get_token_phrases(tokens):
+    '''
+    Helper function for get_line_phrases. Given the phrase tokens of a line
+    (as returned from get_phrase_token), return a list of the possible phrases
+    in it, in order of appearance.
+    '''
+    line_phrases = []
+    temp_phrase = []
+    for token in tokens:
+        if token:
+            temp_phrase.append(token)
+        elif token is None:
+            if (len(temp_phrase) >= 3) and (IS_TOKEN in temp_phrase):
+                line_phrases.append(temp_phrase)
+            temp_phrase = []
+    
+    # append if reached the end of the line
+    if (len(temp_phrase) >= 3) and (IS_TOKEN in temp_phrase):
+        line_phrases.append(temp_phrase)
+    
+    return line_phrases
+
+
+def merge_phrases(phrases_per_line):
+    '''
+    Helper function for get_phrases. Given a list of phrase lists (one per
+    line), return a single list of the unique phrases, keeping the first
+    occurrence of each.
+    '''
+    all_phrases = []
+    for line_phrases in phrases_per_line:
+        for phrase in line_phrases:
+            if phrase not in all_phrases:
+                all_phrases.append(phrase)
     return all_phrases
 
+
+def get_phrases(level_description):
+    '''
+    Helper function for parse_rules. Given level_description (2D array of
+    tokens), return a list of unique possible phrases (lists of word tokens)
+    satisfying the following conditions:
+        - contains at least 3 words
+        - contains "IS"
+    '''
+    # parse horizontally
+    return merge_phrases(get_line_phrases(row) for row in level_description)
+
 def strip_AND(phrase, word_type):
     '''
     Helper function for parse_rules. Returns a list of filtered words in
-    phrase (a list of words), given that they are of word_type (NOUNS or PROPERTIES)
+    phrase (a list of word tokens), given that they are of word_type
+    (NOUN_TOKENS or PROPERTY_TOKENS)
     Also checks the validity of the syntax. Returns an empty list if not valid.
     '''
     stripped = []
@@ -56,47 +222,196 @@ def strip_AND(phrase, word_type):
         
         # first word must be of word_type
         if i%2 == 0:
-            if phrase[i] in word_type:    # word_type refers to NOUNS or PROPERTIES
+            if phrase[i] in word_type:    # word_type refers to NOUN_TOKENS or PROPERTY_TOKENS
                 stripped.append(phrase[i])
         
         # following word must be 'AND' conjunction
         if i%2 == 1:
             # return empty list if syntax is not met
-            if phrase[i] != 'AND':
+            if phrase[i] != AND_TOKEN:
                 return []
     
     return stripped
     
 
+class PropertyRules(dict):
+    '''
+    A property_rules dict (maps an object (str) to a set of properties) kept as
+    a compatibility view of the compiled form used by Board:
+        - masks maps an object token to an int bitmask of its properties (PROPERTY_BITS)
+        - you_objs, win_objs and defeat_objs list the object tokens with that property
+        - push_objs, pull_objs and stop_objs are the sets of object tokens that
+          are PUSH, PULL, and STOP but not PUSH (i.e. that block a move)
+    The view is built once on creation from masks, so it must not be modified.
+    '''
+    def __init__(self, masks):
+        super().__init__(
+            (get_name(obj), {property_ for property_, bit in PROPERTY_BITS.items() if mask & bit})
+            for obj, mask in masks.items()
+        )
+        
+        self.masks = masks
+        self.you_objs = self.get_objs(YOU_BIT)
+        self.win_objs = self.get_objs(WIN_BIT)
+        self.defeat_objs = self.get_objs(DEFEAT_BIT)
+        self.push_objs = frozenset(self.get_objs(PUSH_BIT))
+        self.pull_objs = frozenset(self.get_objs(PULL_BIT))
+        # If "ROCK" has both the "PUSH" and "STOP" properties,
+        # then the "PUSH" behavior takes priority
+        self.stop_objs = frozenset(self.get_objs(STOP_BIT)) - self.push_objs
+    
+    
+    def get_objs(self, bit):
+        '''
+        Return a list of the object tokens whose properties include bit.
+        '''
+        return [obj for obj, mask in self.masks.items() if mask & bit]
+
+
+class NounRules(dict):
+    '''
+    A noun_rules dict (maps a graphical object (str) to the one it will change
+    to) kept as a compatibility view of tokens, the same mapping between object
+    tokens, which is what Board uses.
+    '''
+    def __init__(self, tokens):
+        super().__init__((get_name(obj), get_name(new_obj)) for obj, new_obj in tokens.items())
+        self.tokens = tokens
+
+
+def compile_rules(property_rules):
+    '''
+    Return property_rules (dict mapping an object to a set of properties) as a
+    PropertyRules instance, compiling it only if it isn't one already.
+    '''
+    if isinstance(property_rules, PropertyRules):
+        return property_rules
+    
+    masks = {}
+    for obj, properties in property_rules.items():
+        masks[get_token(obj)] = 0
+        for property_ in properties:
+            masks[get_token(obj)] |= PROPERTY_BITS.get(property_, 0)
+    return PropertyRules(masks)
+
+
+def compile_noun_rules(noun_rules):
+    '''
+    Return noun_rules (dict mapping a graphical object to another one) as a
+    NounRules instance, compiling it only if it isn't one already.
+    '''
+    if isinstance(noun_rules, NounRules):
+        return noun_rules
+    return NounRules({get_token(obj): get_token(new_obj) for obj, new_obj in noun_rules.items()})
+
+
+class Stats:
+    '''
+    Instrumentation for the games it is attached to (as game.stats, which is
+    None by default, so that it costs nothing when it isn't used). Collects:
+        - steps: the number of steps taken
+        - seconds: maps each phase of step_game in PHASES to the total seconds spent in it
+        - events: maps an event name to a Counter of the values recorded for it:
+            "push_chain" / "pull_chain": number of objects in each chain moved
+            "phrases": number of phrases found by each parse of the rules
+            "rule_change": step number whenever a parse gave different rules
+    If a callback is given, it is also called as callback(name, value) for
+    every phase timed (with its seconds) and every event recorded.
+    '''
+    PHASES = ("parse_rules", "move", "adjust_nouns", "is_defeat", "is_win")
+    
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.steps = 0
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.events = {}
+        self.rules = None       # last rules parsed, to detect rule changes
+        self.lap_start = None
+    
+    
+    def start_step(self):
+        '''
+        Count a new step and start timing its first phase.
+        '''
+        self.steps += 1
+        self.lap_start = time.perf_counter()
+    
+    
+    def lap(self, phase):
+        '''
+        Add the time since the previous lap (or start_step) to phase.
+        '''
+        now = time.perf_counter()
+        seconds = now - self.lap_start
+        self.seconds[phase] += seconds
+        self.lap_start = now
+        if self.callback is not None:
+            self.callback(phase, seconds)
+    
+    
+    def record(self, event, value):
+        '''
+        Count one occurrence of value for event.
+        '''
+        if event not in self.events:
+            self.events[event] = collections.Counter()
+        self.events[event][value] += 1
+        if self.callback is not None:
+            self.callback(event, value)
+    
+    
+    def record_rules(self, property_rules, noun_rules):
+        '''
+        Record a "rule_change" event if these rules differ from the last ones
+        recorded.
+        '''
+        rules = (property_rules.masks, noun_rules.tokens)
+        if self.rules is not None and rules != self.rules:
+            self.record("rule_change", self.steps)
+        self.rules = rules
+    
+    
+    def as_dict(self):
+        '''
+        Return the stats collected so far as a JSON-serializable dict.
+        '''
+        return {
+            "steps": self.steps,
+            "seconds": dict(self.seconds),
+            "events": {event: {str(value): count for value, count in sorted(counter.items())}
+                       for event, counter in self.events.items()},
+        }
+
+
 def parse_rules(game):
     '''
     Given game (an instance of Board), return property_rules and noun_rules dict.
-    property_rules maps an object to a set of properties.
+    property_rules maps an object to a set of properties (as a PropertyRules dict).
     noun_rules maps a graphical object (lowercase) to another graphical object
-    (lowercase) it will change to.
+    (lowercase) it will change to (as a NounRules dict).
+    Both are parsed from word tokens; the dicts keyed by str are only views.
+
+    The result is cached on the game until a move changes one of its phrases,
+    so the returned dicts must not be modified.
     '''
-    property_rules = {}
-    noun_rules = {}
+    # Reuse the previous rules if no cell in a phrase line has changed
+    if game.rules is not None:
+        return game.rules
+    
+    masks = {}          # maps an object token to a bitmask of properties
+    noun_rules = {}     # maps an object token to another object token
     
     
     # Text objects all have a default property of PUSH
-    for word in WORDS:
-        property_rules[word] = set()
-        property_rules[word].add("PUSH")
+    for word in WORD_TOKENS:
+        masks[word] = PUSH_BIT
     
     
-    # Get potential phrases
-        # first get horizontal phrases
-    phrases = get_phrases(game.level_description)
-        
-        # get vertical phrases by transposing the 2D list
-    columns = []
-    for i in range(game.cols):
-        columns.append([row[i] for row in game.level_description])
-        
-        # add the vertical and horizontal possible phrases
-    phrases += get_phrases(columns)
-    print("phrases", phrases, "\n")
+    # Get potential phrases (horizontal, then vertical), re-scanning only
+    # the rows and columns that changed since the last parse
+    phrases = game.get_phrases()
+    if game.stats is not None:
+        game.stats.record("phrases", len(phrases))
     
     
     # Match rule patterns
@@ -111,77 +426,244 @@ def parse_rules(game):
             
             # NOUN RULES
             # Ex. NOUN IS NOUN IS NOUN
-            if (word1 in NOUNS) and (word2 == "IS") and (word3 in NOUNS):
-                original = word1.lower()
-                change_to = word3.lower()
+            if (word1 in NOUN_TOKENS) and (word2 == IS_TOKEN) and (word3 in NOUN_TOKENS):
+                original = word1 & ~TEXT_FLAG     # the graphical object of a noun
+                change_to = word3 & ~TEXT_FLAG
                 
                 noun_rules[original] = change_to
     
             # PROPERTY RULES
             # Ex. NOUN IS PROPERTY
-            if (word1 in NOUNS) and (word2 == "IS") and (word3 in PROPERTIES):
-                noun = word1.lower()
+            if (word1 in NOUN_TOKENS) and (word2 == IS_TOKEN) and (word3 in PROPERTY_TOKENS):
+                noun = word1 & ~TEXT_FLAG
                 property_ = word3
                 
-                if noun not in property_rules:
-                    property_rules[noun] = set()
-                property_rules[noun].add(property_)
+                masks[noun] = masks.get(noun, 0) | PROPERTY_TOKEN_BITS[property_]
         
         
         # Complex cases:
             # AND rules
-        if "AND" in phrase:
+        if AND_TOKEN in phrase:
             
             # split on "IS": divides between phrase_1 and phrase_2 object mapping
-            IS_index = phrase.index("IS")
+            IS_index = phrase.index(IS_TOKEN)
             phrase_1 = phrase[:IS_index]
             phrase_2 = phrase[IS_index+1:]
             
             # check valid syntax in noun_phrase and property_phrase
-            nouns_1 = strip_AND(phrase_1, NOUNS)
-            nouns_2 = strip_AND(phrase_2, NOUNS)
-            properties_2 = strip_AND(phrase_2, PROPERTIES)
+            nouns_1 = strip_AND(phrase_1, NOUN_TOKENS)
+            nouns_2 = strip_AND(phrase_2, NOUN_TOKENS)
+            properties_2 = strip_AND(phrase_2, PROPERTY_TOKENS)
             
             # Ex. NOUN AND NOUN IS NOUN AND NOUN
             # valid syntax if nouns_1 and nouns_2 are not empty lists
             if nouns_1 and nouns_2:
                 # map each noun to the other noun
                 for noun in nouns_1:
-                    noun_rules[noun.lower()] = nouns_2[0].lower()
+                    noun_rules[noun & ~TEXT_FLAG] = nouns_2[0] & ~TEXT_FLAG
             
             # Ex. NOUN AND NOUN IS PROPERTY
             # valid syntax if nouns_1 and properties_2 are not empty lists
             if nouns_1 and properties_2:
                 # map each noun to the property
                 for noun in nouns_1:
-                    property_rules[noun.lower()] = set(property_ for property_ in properties_2)
+                    masks[noun & ~TEXT_FLAG] = 0
+                    for property_ in properties_2:
+                        masks[noun & ~TEXT_FLAG] |= PROPERTY_TOKEN_BITS[property_]
     
-    print("property_rules", property_rules, "\n")
-    print("noun_rules", noun_rules, "\n")
+    property_rules = PropertyRules(masks)
+    noun_rules = NounRules(noun_rules)
+    if game.stats is not None:
+        game.stats.record_rules(property_rules, noun_rules)
+    game.rules = (property_rules, noun_rules)
     return property_rules, noun_rules
 
 
 class Board:
     def __init__(self, level_description):
         '''
-        Initializer for Board instance. Contains level_description, number of rows, and cols.
+        Initializer for Board instance. Contains level_description (with tokens
+        for objects, see encode_level), number of rows, and cols.
+        Also caches the phrases found in each row and column, and the rules parsed
+        from them, so level_description should only be changed through Board methods.
         '''
         self.level_description = level_description
         self.rows = len(level_description)
         self.cols = len(level_description[0])
+        
+        self.clear_phrases()    # phrase cache: None marks a row/column that needs to be re-scanned
+        self.rules = None   # (property_rules, noun_rules) from the last parse
+        self.changed_cells = set()  # locations changed since the last dump_changes
+        self.journal = None     # list of changes per step, while journaling (see start_journal)
+        self.stats = None       # Stats instance, if instrumented (shared with copies)
+        
+        self.build_index()
+        # both kept up to date by add_obj/remove_obj/replace_obj
+        self.object_hashes = self.compute_object_hashes()
+        self.hash = 0
+        for hash_ in self.object_hashes.values():
+            self.hash ^= hash_
     
     
-    def get_locations(self, obj):
+    def clear_phrases(self):
         '''
-        Return a list of tuple locations (x,y) for given (str) obj
+        Mark every row and column as needing to be scanned for phrases.
         '''
-        locations = []
+        self.row_phrases = [None] * self.rows
+        self.col_phrases = [None] * self.cols
+    
+    
+    def build_index(self):
+        '''
+        Build the object index: maps an obj (token) to a dict of {location (tuple): count}.
+        level_description itself is the location -> objects view.
+        '''
+        self.locations = {}
         for i in range(self.rows):
             for j in range(self.cols):
-                # check that there's more than one of the same obj in a given location
-                for index in range(len(self.level_description[i][j])):
-                    if self.level_description[i][j][index] == obj:
-                        locations.append((i,j))
+                for obj in self.level_description[i][j]:
+                    self.index_add(obj, (i,j))
+    
+    
+    def index_add(self, obj, location):
+        '''
+        Record one more obj (token) at location (tuple (x,y)) in the object index.
+        '''
+        obj_locations = self.locations.setdefault(obj, {})
+        obj_locations[location] = obj_locations.get(location, 0) + 1
+    
+    
+    def index_remove(self, obj, location):
+        '''
+        Record one less obj (token) at location (tuple (x,y)) in the object index.
+        '''
+        obj_locations = self.locations[obj]
+        if obj_locations[location] == 1:
+            del obj_locations[location]
+        else:
+            obj_locations[location] -= 1
+    
+    
+    def compute_object_hashes(self):
+        '''
+        Return a dict mapping every obj (token) on the board to the Zobrist hash
+        of where its copies are (the XOR of their keys), from the object index.
+        '''
+        object_hashes = {}
+        for obj, obj_locations in self.locations.items():
+            hash_ = 0
+            for (x, y), count in obj_locations.items():
+                for k in range(count):
+                    hash_ ^= get_zobrist_key(x, y, obj, k)
+            object_hashes[obj] = hash_
+        return object_hashes
+    
+    
+    def objects_hash(self, objs):
+        '''
+        Return the Zobrist hash of where the given objs (iterable of tokens) are
+        on the board, which only changes when one of them is added, removed or moved.
+        '''
+        hash_ = 0
+        for obj in objs:
+            hash_ ^= self.object_hashes.get(obj, 0)
+        return hash_
+    
+    
+    def compute_hash(self):
+        '''
+        Return the Zobrist hash of the board from scratch: the XOR of the keys
+        of every object in every cell.
+        '''
+        hash_ = 0
+        for i in range(self.rows):
+            for j in range(self.cols):
+                cell = self.level_description[i][j]
+                for index, obj in enumerate(cell):
+                    hash_ ^= get_zobrist_key(i, j, obj, cell[:index].count(obj))
+        return hash_
+    
+    
+    def state_hash(self):
+        '''
+        Return the 64-bit Zobrist hash of the board, which only depends on which
+        objects are in which cells. It is not a state identity (e.g. for search
+        or deduplication): boards whose cells hold the same objects in another
+        order have the same hash, yet pushing depends on that order, so they
+        can step differently. Compare level_description on a hash hit.
+        '''
+        return self.hash
+    
+    
+    def copy(self):
+        '''
+        Return an independent copy of this Board. The cached phrases and rules
+        are shared, since they are replaced rather than modified.
+        '''
+        board = copy.copy(self)
+        board.level_description = self.copy_level()
+        board.row_phrases = self.row_phrases.copy()
+        board.col_phrases = self.col_phrases.copy()
+        board.changed_cells = self.changed_cells.copy()
+        if self.journal is not None:
+            board.journal = [changes.copy() for changes in self.journal]
+        board.copy_index()
+        return board
+    
+    
+    def copy_level(self):
+        '''
+        Helper function for copy. Return a copy of level_description whose cells
+        can be changed independently.
+        '''
+        return [[cell.copy() for cell in row] for row in self.level_description]
+    
+    
+    def copy_index(self):
+        '''
+        Helper function for copy. Replace the object index (shared with the
+        Board this one was copied from) by a copy of it.
+        '''
+        self.locations = {obj: obj_locations.copy() for obj, obj_locations in self.locations.items()}
+        self.object_hashes = self.object_hashes.copy()
+    
+    
+    def mark_dirty(self, location):
+        '''
+        Forget the cached phrases for the row and column of location (tuple (x,y)),
+        along with the cached rules.
+        '''
+        x, y = location
+        self.row_phrases[x] = None
+        self.col_phrases[y] = None
+        self.rules = None
+    
+    
+    def get_phrases(self):
+        '''
+        Return the list of unique possible phrases on the board (horizontal ones
+        first, then vertical ones), re-scanning only the rows and columns marked dirty.
+        '''
+        for i in range(self.rows):
+            if self.row_phrases[i] is None:
+                self.row_phrases[i] = get_line_phrases(self.level_description[i])
+        
+        for j in range(self.cols):
+            if self.col_phrases[j] is None:
+                column = [row[j] for row in self.level_description]
+                self.col_phrases[j] = get_line_phrases(column)
+        
+        return merge_phrases(self.row_phrases) + merge_phrases(self.col_phrases)
+    
+    
+    def get_locations(self, obj):
+        '''
+        Return a list of tuple locations (x,y) for given (token) obj, in row-major
+        order and repeated if there's more than one of the same obj in a location
+        '''
+        locations = []
+        for location, count in sorted(self.locations.get(obj, {}).items()):
+            locations += [location] * count
         return locations
     
     
@@ -201,21 +683,147 @@ class Board:
         object with a 'STOP' property
         '''
         new_x, new_y = new_location
+        stop_objs = compile_rules(property_rules).stop_objs
         
         for obj in self.level_description[new_x][new_y]:
-            if obj in property_rules:
-                # If "ROCK" has both the "PUSH" and "STOP" properties,
-                # then the "PUSH" behavior takes priority
-                if "PUSH" in property_rules[obj]:
-                    continue
-                if "STOP" in property_rules[obj]:
-                    return False
+            if obj in stop_objs:
+                return False
         return True     # defaults to True after exiting loop
     
     
+    def add_obj(self, obj, location, index=None):
+        '''
+        Append obj (token) to the cell at location (tuple (x,y)), or insert it
+        at position index, keeping the hash, the object index, the phrase cache,
+        changed_cells and the journal up to date.
+        '''
+        x, y = location
+        cell = self.level_description[x][y]
+        token = get_phrase_token(cell)
+        if index is None:
+            index = len(cell)
+        
+        key = get_zobrist_key(x, y, obj, cell.count(obj))
+        self.hash ^= key
+        self.object_hashes[obj] = self.object_hashes.get(obj, 0) ^ key
+        cell.insert(index, obj)
+        self.index_add(obj, location)
+        self.changed_cells.add(location)
+        if self.journal:
+            self.journal[-1].append(("add", location, index, obj))
+        
+        # rules only need re-parsing if what this cell contributes to a phrase changed
+        if get_phrase_token(cell) != token:
+            self.mark_dirty(location)
+    
+    
+    def remove_obj(self, obj, location, index=None):
+        '''
+        Remove the first occurrence of obj (token) from the cell at location
+        (tuple (x,y)), or the one at position index, keeping the hash, the
+        object index, the phrase cache, changed_cells and the journal up to date.
+        '''
+        x, y = location
+        cell = self.level_description[x][y]
+        token = get_phrase_token(cell)
+        if index is None:
+            index = cell.index(obj)
+        
+        del cell[index]
+        key = get_zobrist_key(x, y, obj, cell.count(obj))
+        self.hash ^= key
+        self.object_hashes[obj] ^= key
+        self.index_remove(obj, location)
+        self.changed_cells.add(location)
+        if self.journal:
+            self.journal[-1].append(("remove", location, index, obj))
+        
+        if get_phrase_token(cell) != token:
+            self.mark_dirty(location)
+    
+    
+    def replace_obj(self, index, new_obj, location):
+        '''
+        Replace the object at position index of the cell at location (tuple (x,y))
+        with new_obj (token), keeping the hash, the object index, the phrase cache,
+        changed_cells and the journal up to date. Replacing an object with itself
+        (e.g. by a SNEK IS SNEK rule) changes nothing.
+        '''
+        x, y = location
+        cell = self.level_description[x][y]
+        old_obj = cell[index]
+        if new_obj == old_obj:
+            return
+        token = get_phrase_token(cell)
+        
+        old_key = get_zobrist_key(x, y, old_obj, cell.count(old_obj) - 1)
+        new_key = get_zobrist_key(x, y, new_obj, cell.count(new_obj))
+        self.hash ^= old_key ^ new_key
+        self.object_hashes[old_obj] ^= old_key
+        self.object_hashes[new_obj] = self.object_hashes.get(new_obj, 0) ^ new_key
+        cell[index] = new_obj
+        self.index_remove(old_obj, location)
+        self.index_add(new_obj, location)
+        self.changed_cells.add(location)
+        if self.journal:
+            self.journal[-1].append(("replace", location, index, old_obj, new_obj))
+        
+        if get_phrase_token(cell) != token:
+            self.mark_dirty(location)
+    
+    
+    def start_journal(self):
+        '''
+        Start recording every change made by step_game, so that undo_step can
+        revert steps without copying the board.
+        '''
+        self.journal = []
+    
+    
+    def stop_journal(self):
+        '''
+        Stop recording changes and forget the recorded steps.
+        '''
+        self.journal = None
+    
+    
+    def begin_step(self):
+        '''
+        Start a new journal entry for the changes of the next step (if the
+        journal is on). Called by step_game.
+        '''
+        if self.journal is not None:
+            self.journal.append([])
+    
+    
+    def undo_step(self):
+        '''
+        Revert the changes of the last journaled step, restoring the board
+        (including the order of objects within cells) exactly. Returns the
+        list of reverted changes, or None if there was no step to undo.
+        '''
+        if not self.journal:
+            return None
+        
+        journal, self.journal = self.journal, None  # don't record the undo itself
+        changes = journal.pop()
+        try:
+            for change in reversed(changes):
+                kind, location, index = change[:3]
+                if kind == "add":
+                    self.remove_obj(change[3], location, index)
+                elif kind == "remove":
+                    self.add_obj(change[3], location, index)
+                else:
+                    self.replace_obj(index, change[3], location)
+        finally:
+            self.journal = journal
+        return changes
+    
+    
     def move_obj(self, obj, current, direction):
         '''
-        Move a given obj (str) from location current (tuple (x,y)) in
+        Move a given obj (token) from location current (tuple (x,y)) in
         the given direction (tuple (dx,dy))
         '''
         # unpack x and y components
@@ -223,23 +831,26 @@ class Board:
         dx, dy = direction
     
         # remove the object from its current location
-        self.level_description[x][y].remove(obj) 
+        self.remove_obj(obj, (x, y))
         
         # add the object to its new location
-        self.level_description[x+dx][y+dy].append(obj)
+        self.add_obj(obj, (x+dx, y+dy))
     
     
     def get_push_chain(self, property_rules, current, direction):
         '''
         PUSH SCENARIO:
-            Returns a dictionary obj_sequence (mapping an obj (str) to a set of tuple locations)
-            of all the objects that will be pushed by you object (str) in current (tuple) location
+            Returns a dictionary obj_sequence (mapping an obj (token) to a set of tuple locations)
+            of all the objects that will be pushed by you object (token) in current (tuple) location
         '''
+        property_rules = compile_rules(property_rules)
+        push_objs = property_rules.push_objs
+        pull_objs = property_rules.pull_objs
         x, y = current
         dx, dy = direction
         
         # get all the objects who are in the chain line, excluding the YOU object
-        obj_sequence = {}   # maps object (str) to a list of locations (tuple)
+        obj_sequence = {}   # maps object (token) to a list of locations (tuple)
         
         
         # loop to find the chain of items to be pushed
@@ -256,49 +867,48 @@ class Board:
                 exists_push = False
                 
                 # add object to obj_sequence if it has PUSH property
-                if (elt in property_rules) and ("PUSH" in property_rules[elt]):
+                if elt in push_objs:
                     
                     exists_push = True  # change to True if there exists a push chain
                     
                     if elt not in obj_sequence:
                         obj_sequence[elt] = []
                     obj_sequence[elt].append((x+dx, y+dy))
-                    print("generic obj_sequence", obj_sequence)
                     
                     # also check that the pushed object can pull another object
                     current_obj = self.level_description[x][y]
-                    print("current_obj", current_obj)
                     for elt in current_obj:
                         
                         # add object to obj_sequence if it has PULL property
-                        if (elt in property_rules) and ("PULL" in property_rules[elt]):
+                        if elt in pull_objs:
                             if elt not in obj_sequence:
                                 obj_sequence[elt] = []
                             obj_sequence[elt].append((x,y))
                 
              # stop checking for more push objects if the chain breaks
             if not exists_push:
-                print("obj_sequence", obj_sequence)
                 return obj_sequence
                 
             x = x+dx
             y = y+dy
         
-        print("obj_sequence", obj_sequence)
         return obj_sequence
     
     
     def get_pull_chain(self, property_rules, current, direction):
         '''
         PULL SCENARIO:
-            Returns a dictionary obj_sequence (mapping an obj (str) to a list of tuple locations)
-            of all the objects that will be pulled by you object (str) in the "current" location
+            Returns a dictionary obj_sequence (mapping an obj (token) to a list of tuple locations)
+            of all the objects that will be pulled by you object (token) in the "current" location
         '''
+        property_rules = compile_rules(property_rules)
+        push_objs = property_rules.push_objs
+        pull_objs = property_rules.pull_objs
         x, y = current
         dx, dy = direction
         
         # get all the objects who have pull property
-        obj_sequence = {}   # maps object (str) to a list of locations (tuple)
+        obj_sequence = {}   # maps object (token) to a list of locations (tuple)
         
 
         # move backwards (opposite of direction) to find a potential pull object
@@ -312,7 +922,7 @@ class Board:
             for elt in prev_obj:
                 
                 # if object has PULL property
-                if (elt in property_rules) and ("PULL" in property_rules[elt]):
+                if elt in pull_objs:
                     
                     # check if it can be pulled to a valid position
                     if self.is_within_boundaries((x, y)) and self.is_not_stop(property_rules, (x, y)):
@@ -325,7 +935,7 @@ class Board:
                         # Also check that the pulled object can push another one
                         current_obj = self.level_description[x][y]
                         for elt in current_obj:
-                            if (elt in property_rules) and ("PUSH" in property_rules[elt]):
+                            if elt in push_objs:
                                 if elt not in obj_sequence:
                                     obj_sequence[elt] = []
                                 obj_sequence[elt].append((x, y))
@@ -358,7 +968,8 @@ class Board:
         '''
         pull_sequence = self.get_pull_chain(property_rules, current, direction)
         self.move_chain(pull_sequence, direction)
-        print(f"pull_sequence from {current}:", pull_sequence)
+        if self.stats is not None:
+            self.stats.record("pull_chain", sum(map(len, pull_sequence.values())))
         
         
     def push(self, you, property_rules, current, direction):
@@ -379,96 +990,105 @@ class Board:
                     return False    # means that YOU also can't be moved
             
         self.move_chain(push_sequence, direction)
-        print(f"push_sequence from {current}:", push_sequence)
+        if self.stats is not None:
+            self.stats.record("push_chain", sum(map(len, push_sequence.values())))
                 
     
     def move(self, property_rules, direction):
         '''
         Given the property_rules (dict) and direction, move all the YOU objects
         according to rules in lab 10.
+        
+        The YOU objects are moved one at a time (each YOU object type in turn,
+        in row-major order), and each move can push or pull the others, so
+        neither the order nor when each type's locations are gathered can change.
         '''
+        property_rules = compile_rules(property_rules)
+        stop_objs = property_rules.stop_objs
+        level = self.level_description
+        rows, cols = self.rows, self.cols
+        
         # unpack direction components
-        dx, dy = direction_vector[direction]
+        dx, dy = direction = direction_vector[direction]
         
-        # get all the unique objects with property YOU
-        YOU_objects = {obj for obj in property_rules if "YOU" in property_rules[obj]}
+        # every YOU object with its location, in the order they move
+        movers = ((you, loc) for you in property_rules.you_objs for loc in self.get_locations(you))
         
-        # loop through each YOU object
-        for you in YOU_objects:
-            # get a list of tuples
-            locations = self.get_locations(you)
+        for you, loc in movers:
+            # unpack x,y components
+            you_x, you_y = loc
+            new_x, new_y = you_x+dx, you_y+dy
             
-            # loop through each location of the YOU object
-            for loc in locations:
-                # unpack x,y components
-                you_x, you_y = loc
-                
-                # check if the new position is a valid move
-                if (self.is_within_boundaries((you_x+dx, you_y+dy)) and
-                    self.is_not_stop(property_rules, (you_x+dx, you_y+dy))):
-                    
-                    
-                    next_obj = self.level_description[you_x+dx][you_y+dy]
-                    try:
-                        prev_obj = self.level_description[you_x-dx][you_y-dy]
-                    except IndexError:
-                        prev_obj = []
-                    
-                    
-                    # if next_obj and prev_obj is empty, simply move the YOU object
-                    if len(next_obj) == len(prev_obj) == 0:
-                        self.move_obj(you, (you_x,you_y), (dx,dy))
-                    
-                    
-                    # if next obj and prev obj != 0: push and pull
-                    elif len(next_obj) != 0 and len(prev_obj) != 0:
-                        # push is not allowed, so YOU also can't move
-                        if self.push(you, property_rules, (you_x,you_y), (dx,dy)) == False:
-                            continue
-                        self.pull(you, property_rules, (you_x,you_y), (dx,dy))
-                        self.move_obj(you, (you_x,you_y), (dx,dy))
-                    
-                    
-                    # elif next_obj != 0: push
-                    elif len(next_obj) != 0:
-                        # push is not allowed, so YOU also can't move
-                        if self.push(you, property_rules, (you_x,you_y), (dx,dy)) == False:
-                            continue
-                        self.move_obj(you, (you_x,you_y), (dx,dy))
-                    
-                    
-                    # elif prev_obj != 0: pull
-                    elif len(prev_obj) != 0:
-                        self.pull(you, property_rules, (you_x,you_y), (dx,dy))
-                        self.move_obj(you, (you_x,you_y), (dx,dy))
-                    
-
+            # check if the new position is a valid move
+            if not (0 <= new_x < rows and 0 <= new_y < cols):
+                continue
+            next_obj = level[new_x][new_y]
+            if not stop_objs.isdisjoint(next_obj):
+                continue
+            
+            # (a negative index wraps around to the other side of the board)
+            try:
+                prev_obj = level[you_x-dx][you_y-dy]
+            except IndexError:
+                prev_obj = []
+            
+            
+            # if next_obj and prev_obj is empty, simply move the YOU object
+            if not next_obj and not prev_obj:
+                self.move_obj(you, loc, direction)
+            
+            
+            # if next obj and prev obj != 0: push and pull
+            elif next_obj and prev_obj:
+                # push is not allowed, so YOU also can't move
+                if self.push(you, property_rules, loc, direction) == False:
+                    continue
+                self.pull(you, property_rules, loc, direction)
+                self.move_obj(you, loc, direction)
+            
+            
+            # elif next_obj != 0: push
+            elif next_obj:
+                # push is not allowed, so YOU also can't move
+                if self.push(you, property_rules, loc, direction) == False:
+                    continue
+                self.move_obj(you, loc, direction)
+            
+            
+            # elif prev_obj != 0: pull
+            else:
+                self.pull(you, property_rules, loc, direction)
+                self.move_obj(you, loc, direction)
+    
+    
+    def get_cells_with(self, objs):
+        '''
+        Return the set of tuple locations (x,y) whose cell contains at least one
+        of the given objs (iterable of tokens).
+        '''
+        cells = set()
+        for obj in objs:
+            cells.update(self.locations.get(obj, ()))
+        return cells
+    
+    
     def is_defeat(self, property_rules):
         '''
         Eliminate all YOU objects that land on a square where an object has
         property DEFEAT.
         '''
-        for r in range(self.rows):
-            for c in range(self.cols):
-                square = self.level_description[r][c]
-                
-                you_objs = [obj for obj, property_ in property_rules.items() if "YOU" in property_]
-                defeat_objs = [obj for obj, property_ in property_rules.items() if "DEFEAT" in property_]
-                
-                # Check if there is a DEFEAT object in the given square
-                is_DEFEAT = False
-                for elt in square:
-                    if elt in defeat_objs:
-                        is_DEFEAT = True
-                        break
-                
-                # if there's a DEFEAT object, eliminate all the YOU objects
-                defeated_square = []
-                if is_DEFEAT:
-                    for obj in square:
-                        if obj not in you_objs:
-                            defeated_square.append(obj)
-                    self.level_description[r][c] = defeated_square
+        property_rules = compile_rules(property_rules)
+        you_objs = property_rules.you_objs
+        defeat_objs = property_rules.defeat_objs
+        
+        # only the squares holding a DEFEAT object need to be checked
+        for location in self.get_cells_with(defeat_objs):
+            x, y = location
+            square = self.level_description[x][y]
+            
+            # eliminate all the YOU objects
+            for obj in [obj for obj in square if obj in you_objs]:
+                self.remove_obj(obj, location)
         
         
     
@@ -477,39 +1097,40 @@ class Board:
         Return True if a YOU object lands on a square that contains an object
         with a WIN property. Else returns False.
         '''
-        for r in range(self.rows):
-            for c in range(self.cols):
-                square = self.level_description[r][c]
-                
-                you_objs = [obj for obj, property_ in property_rules.items() if "YOU" in property_]
-                win_objs = [obj for obj, property_ in property_rules.items() if "WIN" in property_]
-                
-                # Check if there is a WIN object in the given square
-                is_WIN = False
-                for elt in square:
-                    if elt in win_objs:
-                        is_WIN = True
-                        break
-                
-                # if there's a WIN object, return True if you find a YOU object
-                if is_WIN:
-                    for obj in square:
-                        if obj in you_objs:
-                            return True
+        property_rules = compile_rules(property_rules)
+        you_objs = property_rules.you_objs
+        win_objs = property_rules.win_objs
+        
+        # only the squares holding a WIN object need to be checked
+        for x, y in self.get_cells_with(win_objs):
+            # return True if you find a YOU object
+            for obj in self.level_description[x][y]:
+                if obj in you_objs:
+                    return True
         return False    # default to False if you exited the loop
     
     
+    def has_you(self, property_rules):
+        '''
+        Return True if there is at least one object with property YOU on the board.
+        '''
+        return len(self.get_cells_with(compile_rules(property_rules).you_objs)) != 0
+    
+    
     def adjust_nouns(self, noun_rules):
         '''
         Given noun_rules (dict) mapping, change all key object to the value
         object.
         '''
-        for r in range(self.rows):
-            for c in range(self.cols):
-                for i in range(len(self.level_description[r][c])):
-                    current_obj = self.level_description[r][c][i]
-                    if current_obj in noun_rules:
-                        self.level_description[r][c][i] = noun_rules[current_obj]
+        noun_rules = compile_noun_rules(noun_rules).tokens
+        
+        # each square is visited once, so swapped nouns (a -> b, b -> a) don't chain
+        for location in self.get_cells_with(noun_rules):
+            x, y = location
+            for i in range(len(self.level_description[x][y])):
+                current_obj = self.level_description[x][y][i]
+                if current_obj in noun_rules:
+                    self.replace_obj(i, noun_rules[current_obj], location)
     
     
 def new_game(level_description):
@@ -519,9 +1140,10 @@ def new_game(level_description):
 
     The given description is a list of lists of lists of strs, where UPPERCASE
     strings represent word objects and lowercase strings represent regular
-    objects (as described in the lab writeup).
+    objects (as described in the lab writeup). Cells may also already hold
+    tokens (see server.parse_ascii_level); the Board stores a tokenized copy.
     """
-    return Board(level_description)
+    return Board(encode_level(level_description))
 
 
 def step_game(game, direction):
@@ -534,16 +1156,54 @@ def step_game(game, direction):
     step_game should return a Boolean: True if the game has been won after
     updating the state, and False otherwise.
     """
+    game.begin_step()   # group this step's changes in the journal, if it's on
+    stats = game.stats  # time each phase, if instrumented
+    if stats is not None:
+        stats.start_step()
+    
     property_rules, noun_rules = parse_rules(game)   # evaluate the initial rules
+    if stats is not None:
+        stats.lap("parse_rules")
 
     game.move(property_rules, direction)     # move according to initial rules and direction
+    if stats is not None:
+        stats.lap("move")
     
     property_rules, noun_rules = parse_rules(game)   # Parse the text objects and update the rules accordingly
+    if stats is not None:
+        stats.lap("parse_rules")
     game.adjust_nouns(noun_rules)    # Adjust object types based on rules whose predicate is a noun
+    if stats is not None:
+        stats.lap("adjust_nouns")
     
     game.is_defeat(property_rules)  # Eliminate any objects that are on DEFEAT squares
+    if stats is not None:
+        stats.lap("is_defeat")
     
-    return game.is_win(property_rules)  # Check if player won
+    victory = game.is_win(property_rules)  # Check if player won
+    if stats is not None:
+        stats.lap("is_win")
+    return victory
+
+
+def step_game_many(game, directions):
+    """
+    Given a game representation (as returned from new_game) and a sequence of
+    directions, apply them in order with step_game, stopping early once the
+    game is won or there are no YOU objects left.
+
+    Returns a tuple (victory, steps): victory is the result of the last step
+    taken (False if none were), and steps is how many directions were applied,
+    i.e. the index of the first direction that was not.
+    """
+    victory = False
+    steps = 0
+    for direction in directions:
+        victory = step_game(game, direction)
+        steps += 1
+        if victory or not game.has_you(parse_rules(game)[0]):
+            break
+    return victory, steps
 
 
 def dump_game(game):
@@ -556,7 +1216,22 @@ def dump_game(game):
     print out the current state of your game for testing and debugging on your
     own.
     """
-    return game.level_description
+    return decode_level(game.level_description)
+
+
+def dump_changes(game):
+    """
+    Given a game representation (as returned from new_game), return a list of
+    [row, col, objects] for every cell that changed since the last call (or
+    since new_game), where objects is the cell as it would appear in dump_game,
+    and start tracking changes afresh.
+    """
+    changes = [
+        [x, y, [token_names[obj] for obj in game.level_description[x][y]]]
+        for x, y in sorted(game.changed_cells)
+    ]
+    game.changed_cells = set()
+    return changes
 
 
 def beautify(level):
@@ -594,5 +1269,5 @@ if __name__=="__main__":
 
 
 
-    game=Board(level)
+    game=new_game(level)
     parse_rules(game)
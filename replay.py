@@ -0,0 +1,170 @@
+"""Replay files for Snek Is You: a level, its moves and periodic checkpoints"""
+
+import sys
+import gzip
+import json
+import argparse
+
+import lab
+import server
+
+FORMAT = "snek-replay"
+VERSION = 1
+CHECKPOINT_INTERVAL = 50  # default number of moves between checkpoints
+
+
+def pack_board(level_description):
+    """
+    Return a compact, JSON-serializable form of level_description (list of
+    lists of lists of strs): its size and only its occupied cells, as
+    [row, col, objects] in row-major order.
+    """
+    return {
+        "rows": len(level_description),
+        "cols": len(level_description[0]),
+        "cells": [
+            [x, y, list(cell)]
+            for x, row in enumerate(level_description)
+            for y, cell in enumerate(row)
+            if cell
+        ],
+    }
+
+
+def unpack_board(packed):
+    """
+    Return the level description (list of lists of lists of strs) of a board
+    packed by pack_board.
+    """
+    level = [[[] for _ in range(packed["cols"])] for _ in range(packed["rows"])]
+    for x, y, cell in packed["cells"]:
+        level[x][y] = list(cell)
+    return level
+
+
+def record(level_description, moves, interval=CHECKPOINT_INTERVAL):
+    """
+    Play moves (list of directions) on level_description and return the
+    replay: a dict holding the level, the moves and a checkpoint of the
+    board (with the victory after that move) every interval moves.
+    """
+    game = lab.new_game(level_description)
+    checkpoints = []
+    for step, direction in enumerate(moves, 1):
+        victory = lab.step_game(game, direction)
+        if step % interval == 0:
+            checkpoints.append(
+                {"step": step, "victory": victory, "board": pack_board(lab.dump_game(game))}
+            )
+    return {
+        "format": FORMAT,
+        "version": VERSION,
+        "level": pack_board(lab.dump_game(lab.new_game(level_description))),
+        "moves": list(moves),
+        "checkpoints": checkpoints,
+    }
+
+
+def open_file(path, mode):
+    """
+    Open path as text, through gzip if its name ends with .gz.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def save_replay(replay, path):
+    """
+    Save replay (as returned from record) to the file at path, compressed if
+    its name ends with .gz.
+    """
+    with open_file(path, "w") as f:
+        json.dump(replay, f, separators=(",", ":"))
+
+
+def load_replay(path):
+    """
+    Return the Replay stored in the file at path (see save_replay).
+    """
+    with open_file(path, "r") as f:
+        replay = json.load(f)
+    if replay.get("format") != FORMAT or replay.get("version") != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} {FORMAT} file")
+    return Replay(replay)
+
+
+class Replay:
+    """
+    Random access to the boards of a replay (as returned from record): seek
+    restores the closest checkpoint before the wanted move and steps forward
+    from there, and frames steps through the moves lazily.
+    """
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.level = unpack_board(replay["level"])
+        self.moves = replay["moves"]
+        self.checkpoints = sorted(replay["checkpoints"], key=lambda checkpoint: checkpoint["step"])
+
+    def __len__(self):
+        return len(self.moves)
+
+    def seek(self, step):
+        """
+        Return (game, victory): a new game as it is after the first step moves,
+        and whether the last of them won it.
+        """
+        if not 0 <= step <= len(self.moves):
+            raise IndexError(f"step {step} is not between 0 and {len(self.moves)}")
+        start, victory, level = 0, False, self.level
+        for checkpoint in self.checkpoints:
+            if checkpoint["step"] > step:
+                break
+            start, victory, level = checkpoint["step"], checkpoint["victory"], unpack_board(checkpoint["board"])
+
+        game = lab.new_game(level)
+        for direction in self.moves[start:step]:
+            victory = lab.step_game(game, direction)
+        return game, victory
+
+    def frames(self, start=0, stop=None):
+        """
+        Generate (step, victory, game) after each step from start (included,
+        0 being the initial board) to stop (excluded, default: after the last
+        move).  The same game is updated in place from one frame to the next,
+        so it must be copied (or dumped) to be kept.
+        """
+        stop = len(self.moves) + 1 if stop is None else min(stop, len(self.moves) + 1)
+        if start >= stop:
+            return
+        game, victory = self.seek(start)
+        yield start, victory, game
+        for step in range(start + 1, stop):
+            victory = lab.step_game(game, self.moves[step - 1])
+            yield step, victory, game
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="make a replay of a level and its moves")
+    record_parser.add_argument("level", help="level file (.json or .txt)")
+    record_parser.add_argument("moves", help="file of directions, one per line")
+    record_parser.add_argument("output", help="replay file to write (compressed if it ends with .gz)")
+    record_parser.add_argument("--interval", type=int, default=CHECKPOINT_INTERVAL, help="moves between checkpoints")
+
+    show_parser = subparsers.add_parser("show", help="print the board of a replay after some moves")
+    show_parser.add_argument("replay", help="replay file")
+    show_parser.add_argument("step", type=int, help="number of moves")
+    parsed = parser.parse_args()
+
+    if parsed.command == "record":
+        with open(parsed.moves) as f:
+            moves = f.read().strip().splitlines(False)
+        save_replay(record(server.read_level(parsed.level), moves, parsed.interval), parsed.output)
+    else:
+        game, victory = load_replay(parsed.replay).seek(parsed.step)
+        sys.stdout.write(lab.beautify(lab.dump_game(game)))
+        print("victory" if victory else "no victory")
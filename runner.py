@@ -0,0 +1,123 @@
+"""Headless Snek Is You runner: plays input scripts on levels across a process pool"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+import multiprocessing
+
+import lab
+import server
+
+
+@functools.lru_cache(maxsize=None)
+def read_level(path):
+    """
+    Return the level description stored in the file at path (see
+    server.read_level), parsed only once per process.  lab.new_game copies
+    it, so it is shared by all the jobs on that level.
+    """
+    return server.read_level(path)
+
+
+@functools.lru_cache(maxsize=None)
+def read_inputs(path):
+    """
+    Return the tuple of directions stored in the file at path, one per line.
+    """
+    with open(path) as f:
+        return tuple(f.read().strip().splitlines(False))
+
+
+def run_job(job):
+    """
+    Play the input script of job (a (level path, input path) pair) on a new
+    game of its level, stopping early once it is won or defeated (no YOU
+    object left), and return a dict with both paths, the outcome ("win",
+    "defeat", "none", or "error" if the engine raised, with the error), the
+    number of steps played, the Zobrist hash of the final state (16 hex
+    digits) and the seconds taken.
+    """
+    level_path, inputs_path = job
+    result = {"level": level_path, "inputs": inputs_path}
+    start = time.perf_counter()
+    try:
+        game = lab.new_game(read_level(level_path))
+        outcome, steps = "none", 0
+        for direction in read_inputs(inputs_path):
+            steps += 1
+            if lab.step_game(game, direction):
+                outcome = "win"
+                break
+            if not game.has_you(lab.parse_rules(game)[0]):
+                outcome = "defeat"
+                break
+        result.update(outcome=outcome, steps=steps, state_hash=f"{game.state_hash():016x}")
+    except Exception as e:
+        result.update(outcome="error", error=f"{type(e).__name__}: {e}")
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def run_jobs(jobs, processes=None, chunksize=None):
+    """
+    Generate the results of run_job for every job in jobs (list of (level
+    path, input path) pairs), in the same order, running them on a pool of
+    processes (default: one per CPU) that are sent chunksize jobs at a time
+    (default: enough for about four chunks per process).
+    """
+    processes = processes or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, -(-len(jobs) // (processes * 4)))
+    with multiprocessing.Pool(processes) as pool:
+        yield from pool.imap(run_job, jobs, chunksize)
+
+
+def get_jobs(levels, inputs, jobs_file=None):
+    """
+    Return the list of (level path, input path) jobs: the pairs listed in
+    jobs_file (one whitespace-separated pair per line) if given, else every
+    input script in inputs played on every level in levels, else every test
+    level with its own recorded inputs.
+    """
+    if jobs_file is not None:
+        with open(jobs_file) as f:
+            return [tuple(line.split()) for line in f if line.strip()]
+    if levels or inputs:
+        return [(level, script) for level in levels for script in inputs]
+    return [
+        (
+            os.path.join(server.LOCATION, "test_levels", fname),
+            os.path.join(server.LOCATION, "test_inputs", fname.rsplit(".", 1)[0] + ".txt"),
+        )
+        for fname in sorted(os.listdir(os.path.join(server.LOCATION, "test_levels")))
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--levels", nargs="*", default=[], help="level files (.json or .txt)")
+    parser.add_argument("--inputs", nargs="*", default=[], help="input scripts, each played on every level")
+    parser.add_argument("--jobs", help="file of 'level inputs' pairs, one per line, instead of --levels/--inputs")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--chunksize", type=int, default=None, help="jobs sent to a worker at a time")
+    parser.add_argument("--output", help="NDJSON report file (default: standard output)")
+    parsed = parser.parse_args()
+
+    jobs = get_jobs(parsed.levels, parsed.inputs, parsed.jobs)
+    out = open(parsed.output, "w") if parsed.output else sys.stdout
+    outcomes = dict.fromkeys(("win", "defeat", "none", "error"), 0)
+    start = time.perf_counter()
+    try:
+        for result in run_jobs(jobs, parsed.processes, parsed.chunksize):
+            outcomes[result["outcome"]] += 1
+            out.write(json.dumps(result) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    seconds = time.perf_counter() - start
+    summary = ", ".join(f"{count} {outcome}" for outcome, count in outcomes.items())
+    print(f"{len(jobs)} jobs in {seconds:.2f}s ({len(jobs) / max(seconds, 1e-9):.0f} jobs/s): {summary}", file=sys.stderr)
@@ -1,17 +1,339 @@
 import os
 import html
 import json
+import time
+import bisect
+import cProfile
+import secrets
 import importlib
 import mimetypes
+import threading
 import traceback
+import contextlib
+import collections
 
+from socketserver import ThreadingMixIn
 from wsgiref.handlers import read_environ
-from wsgiref.simple_server import make_server
+from wsgiref.simple_server import make_server, WSGIServer
 
 import lab as lab
+import hints
+import sparse
 
 LOCATION = os.path.realpath(os.path.dirname(__file__))
-CURRENT_GAME = None
+
+# Parsed levels and the level catalog, refreshed when the files change
+LEVEL_DIRECTORIES = ("puzzles", "test_levels")
+LEVEL_CACHE = {}  # maps a level path to (mtime, level description with tokens)
+LEVEL_CATALOG = (None, [])  # (mtimes of LEVEL_DIRECTORIES, sorted level names)
+
+# lab.py is reloaded only when its source changes
+LAB_MTIME = os.path.getmtime(lab.__file__)
+RELOAD_LOCK = threading.RLock()  # held by new_game until its game is stored
+
+# Games in progress, keyed by session ID, least recently used first
+MAX_SESSIONS = 1000
+SESSION_IDLE_SECONDS = 60 * 60
+SESSIONS = collections.OrderedDict()
+SESSIONS_LOCK = threading.Lock()
+
+
+# Undo/redo history kept for each game
+HISTORY_CHECKPOINT_INTERVAL = 50  # moves between board snapshots
+HISTORY_MAX_CELLS = 1_000_000  # objects held in one game's snapshots before thinning them
+
+
+# Request metrics, exposed at /metrics
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS = {}  # maps an endpoint name to its EndpointMetrics
+METRICS_LOCK = threading.Lock()
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.requests = collections.Counter()  # by status code
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)  # the last one is +Inf
+        self.latency_sum = 0.0
+        self.response_bytes = 0
+
+
+def record_request(endpoint, status, seconds, size):
+    """
+    Add a request to endpoint, answered with status (e.g. "200 OK") and size
+    bytes after the given seconds, to the metrics.
+    """
+    with METRICS_LOCK:
+        metrics = METRICS.setdefault(endpoint, EndpointMetrics())
+        metrics.requests[status.split()[0]] += 1
+        metrics.latency_counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        metrics.latency_sum += seconds
+        metrics.response_bytes += size
+
+
+def get_metrics():
+    """
+    Return the request metrics and the number of active games in the
+    Prometheus text exposition format.
+    """
+    lines = [
+        "# HELP snek_requests_total Requests handled, by endpoint and status code.",
+        "# TYPE snek_requests_total counter",
+    ]
+    with METRICS_LOCK:
+        endpoints = sorted(METRICS.items())
+        for endpoint, metrics in endpoints:
+            for status, count in sorted(metrics.requests.items()):
+                lines.append(f'snek_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+
+        lines += [
+            "# HELP snek_request_duration_seconds Time taken to answer requests, by endpoint.",
+            "# TYPE snek_request_duration_seconds histogram",
+        ]
+        for endpoint, metrics in endpoints:
+            total = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), metrics.latency_counts):
+                total += count
+                lines.append(f'snek_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {total}')
+            lines.append(f'snek_request_duration_seconds_sum{{endpoint="{endpoint}"}} {metrics.latency_sum}')
+            lines.append(f'snek_request_duration_seconds_count{{endpoint="{endpoint}"}} {total}')
+
+        lines += [
+            "# HELP snek_response_bytes_total Size of the response bodies sent, by endpoint.",
+            "# TYPE snek_response_bytes_total counter",
+        ]
+        for endpoint, metrics in endpoints:
+            lines.append(f'snek_response_bytes_total{{endpoint="{endpoint}"}} {metrics.response_bytes}')
+
+    lines += [
+        "# HELP snek_active_games Games in progress (sessions not yet evicted).",
+        "# TYPE snek_active_games gauge",
+        f"snek_active_games {len(SESSIONS)}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+class History:
+    """
+    Undo/redo history of one game.  Recent moves are undone in place through
+    the game's journal (see lab.Board.start_journal), which only keeps the
+    changes of the last HISTORY_CHECKPOINT_INTERVAL moves.  Older moves are
+    undone by restoring the closest board snapshot, taken every
+    HISTORY_CHECKPOINT_INTERVAL moves, and replaying the moves made since.
+    Snapshots share unchanged rows with the previous one, and every other one
+    is dropped whenever they hold more than HISTORY_MAX_CELLS objects.
+    """
+
+    def __init__(self, game):
+        game.start_journal()
+        self.moves = []  # directions taken since the initial board
+        self.wins = [False]  # victory after each number of moves
+        self.undone = []  # directions that can be redone, next one last
+        self.checkpoints = {}  # maps a number of moves to (snapshot, objects in it)
+        self.checkpoint(game)
+
+    def checkpoint(self, game):
+        """
+        Snapshot game as the board after the current number of moves, then
+        thin out the snapshots if they got too big.
+        """
+        previous = self.checkpoints[max(self.checkpoints)][0] if self.checkpoints else ()
+        snapshot = []
+        for x, row in enumerate(game.level_description):
+            row = tuple(tuple(cell) for cell in row)
+            if x < len(previous) and previous[x] == row:
+                row = previous[x]
+            snapshot.append(row)
+        size = sum(len(cell) for row in snapshot for cell in row)
+        self.checkpoints[len(self.moves)] = (tuple(snapshot), size)
+
+        while len(self.checkpoints) > 1:
+            if sum(size for _, size in self.checkpoints.values()) <= HISTORY_MAX_CELLS:
+                break
+            for moves in sorted(self.checkpoints)[1::2]:
+                del self.checkpoints[moves]
+
+    def record(self, game, direction, victory):
+        """
+        Add a move just made on game to the history.
+        """
+        self.moves.append(direction)
+        self.wins.append(victory)
+        del game.journal[:-HISTORY_CHECKPOINT_INTERVAL]
+        if len(self.moves) % HISTORY_CHECKPOINT_INTERVAL == 0:
+            self.checkpoint(game)
+
+    def step(self, game, directions):
+        """
+        Apply directions to game with lab.step_game_many, forgetting the moves
+        that could be redone.  Returns the same as lab.step_game_many.
+        """
+        frames = len(game.journal)
+        try:
+            victory, steps = lab.step_game_many(game, directions)
+        except Exception:
+            # put the game back as it was, so it still matches the history
+            while len(game.journal) > frames:
+                game.undo_step()
+            raise
+        for direction in directions[: steps - 1]:
+            self.record(game, direction, False)
+        if steps:
+            self.record(game, directions[steps - 1], victory)
+        self.undone.clear()
+        return victory, steps
+
+    def undo(self, game):
+        """
+        Undo the last move made on game.  Returns (game, victory) after the
+        undo; game is a new Board if it had to be restored from a snapshot.
+        """
+        if not self.moves:
+            return game, self.wins[-1]
+        if game.journal:
+            game.undo_step()
+        else:
+            target = len(self.moves) - 1
+            start = max(moves for moves in self.checkpoints if moves <= target)
+            game = lab.new_game(self.checkpoints[start][0])
+            game.start_journal()
+            for direction in self.moves[start:target]:
+                lab.step_game(game, direction)
+            del game.journal[:-HISTORY_CHECKPOINT_INTERVAL]
+        self.undone.append(self.moves.pop())
+        self.wins.pop()
+        self.checkpoints.pop(len(self.moves) + 1, None)
+        return game, self.wins[-1]
+
+    def redo(self, game):
+        """
+        Redo the last undone move on game.  Returns the victory after it.
+        """
+        if not self.undone:
+            return self.wins[-1]
+        direction = self.undone.pop()
+        victory = lab.step_game(game, direction)
+        self.record(game, direction, victory)
+        return victory
+
+
+# Where /profile saves the profiles of the steps of each game
+PROFILE_DIRECTORY = os.path.join(LOCATION, "profiles")
+# Held while a step is profiled: only one profiler can be active in the
+# process at a time (from Python 3.12 on, enabling a second one raises)
+PROFILE_LOCK = threading.Lock()
+
+
+class Profiler:
+    """
+    cProfile profile of the steps of one game numbered first to last (by the
+    session version they lead to; last None meaning until stopped).
+
+    Profiled steps of different games take turns (see PROFILE_LOCK).  From
+    Python 3.12 on, a profile records every thread, so it also includes the
+    requests of other games served during the profiled steps.
+    """
+
+    def __init__(self, first, last=None):
+        self.profile = cProfile.Profile()
+        self.first = first
+        self.last = last
+        self.steps = 0  # steps profiled so far
+
+
+@contextlib.contextmanager
+def profiled(session):
+    """
+    Context manager profiling its body if session is profiling its next step,
+    waiting for any other game's profiled step to be done first.
+    """
+    profiler = session.profiler
+    step = session.version + 1
+    if profiler is None or step < profiler.first or (profiler.last is not None and step > profiler.last):
+        yield
+        return
+    with PROFILE_LOCK:
+        profiler.profile.enable()
+        try:
+            yield
+        finally:
+            profiler.profile.disable()
+            profiler.steps += 1
+
+
+def get_profile_stats(profiler, limit):
+    """
+    Return the limit functions with the highest cumulative time in the
+    profile, with their call counts and times, as a list of dicts.
+    """
+    profiler.profile.create_stats()
+    functions = [
+        {
+            "function": f"{filename}:{line}({name})",
+            "calls": calls,
+            "primitive_calls": primitive_calls,
+            "total_seconds": total,
+            "cumulative_seconds": cumulative,
+        }
+        for (filename, line, name), (primitive_calls, calls, total, cumulative, _) in profiler.profile.stats.items()
+    ]
+    functions.sort(key=lambda function: function["cumulative_seconds"], reverse=True)
+    return functions[:limit]
+
+
+class Session:
+    def __init__(self, game):
+        self.game = game
+        self.history = History(game)
+        self.profiler = None  # Profiler of this game's steps, while profiling
+        self.version = 0  # bumped on every step, so clients can tell if they missed one
+        self.lock = threading.Lock()  # keeps the steps of one game in order
+        self.closed = False  # set when lab is reloaded, see reload_lab
+        self.last_used = time.monotonic()
+
+
+def open_session(game, session_id=None):
+    """
+    Store game under session_id (replacing that session's game if it still
+    exists, or under a new ID otherwise), evicting idle and least recently
+    used sessions as needed.  Returns the session ID.
+    """
+    with SESSIONS_LOCK:
+        if session_id not in SESSIONS:
+            session_id = secrets.token_hex(16)
+        SESSIONS[session_id] = Session(game)
+        SESSIONS.move_to_end(session_id)
+
+        now = time.monotonic()
+        while SESSIONS:
+            oldest_id, oldest = next(iter(SESSIONS.items()))
+            idle = now - oldest.last_used > SESSION_IDLE_SECONDS
+            if not idle and len(SESSIONS) <= MAX_SESSIONS:
+                break
+            del SESSIONS[oldest_id]
+    return session_id
+
+
+@contextlib.contextmanager
+def locked_session(params):
+    """
+    Context manager giving exclusive access to the session named in params.
+    """
+    session_id = params.get("session")
+    with SESSIONS_LOCK:
+        if session_id not in SESSIONS:
+            raise KeyError(f"unknown or expired session {session_id!r}, start a new game")
+        session = SESSIONS[session_id]
+        SESSIONS.move_to_end(session_id)
+    with session.lock:
+        if session.closed:
+            raise KeyError(f"session {session_id!r} ended when lab.py was reloaded, start a new game")
+        session.last_used = time.monotonic()
+        yield session
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
 
 # Code for parsing ASCII level files
 character_map = {
@@ -38,14 +360,25 @@ character_map = {
 }
 
 
-def parse_ascii_level(game_text):
+def parse_ascii_level(game_text, sparse_level=False):
+    # cells hold lab tokens directly, so lab.new_game has nothing to convert
+    token_map = {char: lab.get_token(name) for char, name in character_map.items()}
+    lines = [line.strip() for line in game_text.splitlines(False) if line]
+    if sparse_level:
+        # only the occupied cells, for sparse.new_game
+        return sparse.SparseLevel(
+            len(lines),
+            len(lines[0]),
+            (
+                ((x, y), [token_map[char]])
+                for x, line in enumerate(lines)
+                for y, char in enumerate(line)
+                if char in token_map
+            ),
+        )
     return [
-        [
-            ([character_map[char]] if char in character_map else [])
-            for char in line.strip()
-        ]
-        for line in game_text.splitlines(False)
-        if line
+        [([token_map[char]] if char in token_map else []) for char in line]
+        for line in lines
     ]
 
 
@@ -62,62 +395,224 @@ def parse_post(environ):
         return {}
 
 
+def reload_lab():
+    """
+    Reload lab.py if its source changed since it was last loaded.  Tokens may
+    be numbered differently by the new module, so everything holding them is
+    dropped along with the old one: cached levels and distance fields, and the
+    games in progress, whose sessions end.  The reload takes the lock of every
+    session first, so it waits for the steps being played to finish, and the
+    steps waiting for it find their session closed.
+    """
+    global LAB_MTIME
+    with RELOAD_LOCK:
+        mtime = os.path.getmtime(lab.__file__)
+        if mtime == LAB_MTIME:
+            return
+        print("[reloading lab.py since you changed something]")
+        with SESSIONS_LOCK:
+            sessions = list(SESSIONS.values())
+            SESSIONS.clear()
+        with contextlib.ExitStack() as stack:
+            for session in sessions:
+                stack.enter_context(session.lock)
+                session.closed = True
+            importlib.reload(lab)
+            LAB_MTIME = mtime
+            LEVEL_CACHE.clear()
+            with hints.FIELD_CACHE_LOCK:
+                hints.FIELD_CACHE.clear()
+
+
+def read_level(path):
+    """
+    Parse and return the level description stored in the file at path, either
+    a JSON level (optionally under an "input" key) or an ASCII level (.txt).
+    """
+    with open(path) as f:
+        if path.endswith(".json"):
+            level = json.load(f)
+            if isinstance(level, dict) and "input" in level:
+                level = level["input"]
+            return level
+        elif path.endswith(".txt"):
+            return parse_ascii_level(f.read())
+    raise RuntimeError(f"invalid level filename {path}")
+
+
+def load_level(directory, level):
+    """
+    Return the level description (with tokens) stored in the given file,
+    parsing it only if it changed since it was last loaded.  lab.new_game
+    copies the description, so the cached one is shared between games.
+    """
+    path = os.path.join(LOCATION, directory, level)
+    mtime = os.path.getmtime(path)
+    cached = LEVEL_CACHE.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, lab.encode_level(read_level(path)))
+        LEVEL_CACHE[path] = cached
+    return cached[1]
+
+
 def new_game(params):
-    global CURRENT_GAME
-    print("[reloading lab.py in case you changed something]")
-    importlib.reload(lab)
-    if "raw" in params:
-        level = json.loads(params["raw"])
+    # lab can't be reloaded between building the game and storing it
+    with RELOAD_LOCK:
+        reload_lab()
+        if "raw" in params:
+            level = json.loads(params["raw"])
+        else:
+            level = params["level"]
+            directory = params["directory"]
+            assert directory in LEVEL_DIRECTORIES
+            level = load_level(directory, level)
+        game = lab.new_game(level)
+        lab.dump_changes(game)
+        session_id = open_session(game, params.get("session"))
+        return {
+            "board": lab.dump_game(game),
+            "victory": False,
+            "version": 0,
+            "session": session_id,
+        }
+
+
+def board_update(session, params, out, resync=False):
+    """
+    Add the new board state of session to out after a step: only the cells
+    that changed if the client says it is at the previous version (and resync
+    is False), otherwise the full board.
+    """
+    changes = lab.dump_changes(session.game)
+    in_sync = not resync and params.get("version") == session.version
+    session.version += 1
+    out["version"] = session.version
+    if in_sync:
+        out["changes"] = changes
     else:
-        level = params["level"]
-        directory = params["directory"]
-        assert directory in ("test_levels", "puzzles")
-        with open(os.path.join(LOCATION, directory, level)) as f:
-            if level.endswith(".json"):
-                level = json.load(f)
-                if isinstance(level, dict) and "input" in level:
-                    level = level["input"]
-            elif level.endswith(".txt"):
-                level = parse_ascii_level(f.read())
-            else:
-                raise RuntimeError(
-                    f"invalid level filename {level} in directory {directory}"
-                )
-    CURRENT_GAME = lab.new_game(level)
-    return {
-        "board": lab.dump_game(CURRENT_GAME),
-        "victory": False,
-    }
+        out["board"] = lab.dump_game(session.game)
+    return out
 
 
 def step_game(params):
     direction = params["direction"]
-    victory = lab.step_game(CURRENT_GAME, direction)
-    return {
-        "board": lab.dump_game(CURRENT_GAME),
-        "victory": victory,
-    }
+    with locked_session(params) as session:
+        with profiled(session):
+            victory, _ = session.history.step(session.game, [direction])
+        return board_update(session, params, {"victory": victory})
+
+
+def step_batch(params):
+    directions = params["directions"]
+    with locked_session(params) as session:
+        with profiled(session):
+            victory, steps = session.history.step(session.game, directions)
+        return board_update(session, params, {"victory": victory, "steps": steps})
+
+
+def undo(params):
+    with locked_session(params) as session:
+        with profiled(session):
+            game, victory = session.history.undo(session.game)
+        restored = game is not session.game
+        session.game = game
+        return board_update(session, params, {"victory": victory}, resync=restored)
+
+
+def redo(params):
+    with locked_session(params) as session:
+        with profiled(session):
+            victory = session.history.redo(session.game)
+        return board_update(session, params, {"victory": victory})
+
+
+def profile(params):
+    """
+    Control the profiling of the steps of a game, depending on params["action"]:
+    "start" profiling the steps numbered params["first"] (default: the next
+    one) to params["last"] (default: until stopped), "stop" profiling, or just
+    get the "stats" so far.  Unless profiling wasn't started, returns the
+    params["limit"] (default 20) functions with the highest cumulative time,
+    after saving the whole profile (see pstats) to PROFILE_DIRECTORY.
+    """
+    action = params.get("action", "stats")
+    with locked_session(params) as session:
+        if action == "start":
+            first = params.get("first", session.version + 1)
+            session.profiler = Profiler(first, params.get("last"))
+        profiler = session.profiler
+        if action == "stop":
+            session.profiler = None
+        if profiler is None:
+            return {"profiling": False}
+
+        functions = get_profile_stats(profiler, params.get("limit", 20))
+        os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+        path = os.path.join(PROFILE_DIRECTORY, f"{params['session']}.prof")
+        profiler.profile.dump_stats(path)
+        return {
+            "profiling": session.profiler is not None,
+            "first": profiler.first,
+            "last": profiler.last,
+            "steps": profiler.steps,
+            "file": path,
+            "functions": functions,
+        }
+
+
+def hint(params):
+    """
+    Return the next direction towards the closest WIN cell, and the distance
+    to it, for every YOU object of the game (see hints.get_hints).
+    """
+    with locked_session(params) as session:
+        return {"hints": hints.get_hints(session.game)}
 
 
 def get_levels(params):
-    return sorted(
-        "/".join([dirname, fname])
-        for dirname in ("puzzles", "test_levels")
-        for fname in os.listdir(os.path.join(LOCATION, dirname))
-        if fname.endswith(".txt") or fname.endswith(".json")
-    )
+    """
+    Return the sorted names of all level files, re-listing the level
+    directories only if one of them changed.
+    """
+    global LEVEL_CATALOG
+    mtimes = [
+        os.path.getmtime(os.path.join(LOCATION, dirname))
+        for dirname in LEVEL_DIRECTORIES
+    ]
+    if mtimes != LEVEL_CATALOG[0]:
+        LEVEL_CATALOG = (
+            mtimes,
+            sorted(
+                "/".join([dirname, fname])
+                for dirname in LEVEL_DIRECTORIES
+                for fname in os.listdir(os.path.join(LOCATION, dirname))
+                if fname.endswith(".txt") or fname.endswith(".json")
+            ),
+        )
+    return LEVEL_CATALOG[1]
 
 
 funcs = {
     "new_game": new_game,
     "step_game": step_game,
+    "step_batch": step_batch,
+    "undo": undo,
+    "redo": redo,
+    "profile": profile,
+    "hint": hint,
     "get_levels": get_levels,
 }
 
 
 def application(environ, start_response):
+    start = time.perf_counter()
     path = (environ.get("PATH_INFO", "") or "").lstrip("/")
-    if path in funcs:
+    endpoint = path if path in funcs or path == "metrics" else "static"
+    if path == "metrics":
+        body = get_metrics().encode("utf-8")
+        status = "200 OK"
+        type_ = "text/plain; version=0.0.4"
+    elif path in funcs:
         try:
             out = funcs[path](parse_post(environ))
             body = json.dumps(out).encode("utf-8")
@@ -159,12 +654,14 @@ def application(environ, start_response):
     len_ = str(len(body))
     headers = [("Content-type", type_), ("Content-length", len_)]
     start_response(status, headers)
+    record_request(endpoint, status, time.perf_counter() - start, len(body))
     return [body]
 
 
 if __name__ == "__main__":
+    get_levels({})  # build the level catalog at startup
     print("starting server.  navigate to http://localhost:6009/")
-    with make_server("", 6009, application) as httpd:
+    with make_server("", 6009, application, server_class=ThreadingWSGIServer) as httpd:
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
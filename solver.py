@@ -0,0 +1,370 @@
+"""Breadth-first / A* solver for Snek Is You levels"""
+
+import gc
+import os
+import sys
+import time
+import heapq
+import queue
+import argparse
+import traceback
+import itertools
+import collections
+import multiprocessing
+
+import lab
+import server
+
+DIRECTIONS = ("up", "down", "left", "right")
+
+
+def state_key(game):
+    """
+    Return a key identifying the state of game exactly, for the transposition
+    table: (its 64-bit Zobrist hash, its cells as tuples of tokens).  The hash
+    ignores the order of objects within a cell, which pushing depends on, so
+    boards with the same hash are told apart by their cells.
+    """
+    return (game.state_hash(), tuple(tuple(map(tuple, row)) for row in game.level_description))
+
+
+def distance_to_win(game):
+    """
+    A* heuristic: the smallest Manhattan distance between a YOU object and a
+    WIN object under the current rules, or 0 if there are none of either.
+    Rules can change mid-level, so this is a guide rather than a bound.
+    """
+    property_rules, noun_rules = lab.parse_rules(game)
+    you_cells = game.get_cells_with(property_rules.you_objs)
+    win_cells = game.get_cells_with(property_rules.win_objs)
+    if not you_cells or not win_cells:
+        return 0
+    return min(
+        abs(you_x - win_x) + abs(you_y - win_y)
+        for you_x, you_y in you_cells
+        for win_x, win_y in win_cells
+    )
+
+
+def get_path(parents, key):
+    """
+    Return the list of directions leading from the start state to the state
+    with the given key, following the parents links of the transposition table.
+    """
+    path = []
+    while parents[key] is not None:
+        key, direction = parents[key]
+        path.append(direction)
+    return path[::-1]
+
+
+def solve(level_description, heuristic=None, max_nodes=None):
+    """
+    Search for a sequence of directions that wins the given level:
+    breadth-first (giving a shortest solution), or best-first ordered by
+    moves so far plus heuristic(game) if one is given.  States seen before
+    and states without any YOU object are not expanded.
+
+    Returns a dict with the solution (list of directions, or None if none was
+    found within max_nodes expansions), the number of nodes expanded, the
+    number of distinct states visited and the seconds taken.
+    """
+    start_time = time.perf_counter()
+    start = lab.new_game(level_description)
+    start_key = state_key(start)
+
+    # transposition table: maps a state key to (parent key, direction)
+    parents = {start_key: None}
+    order = itertools.count()  # tie-breaker, so games are never compared
+    if heuristic is None:
+        frontier = collections.deque([(0, start, start_key)])
+    else:
+        frontier = [(heuristic(start), next(order), 0, start, start_key)]
+
+    solution = None
+    expanded = 0
+    while frontier and solution is None:
+        if max_nodes is not None and expanded >= max_nodes:
+            break
+        if heuristic is None:
+            depth, game, key = frontier.popleft()
+        else:
+            _, _, depth, game, key = heapq.heappop(frontier)
+        expanded += 1
+
+        for direction in DIRECTIONS:
+            child = game.copy()
+            victory = lab.step_game(child, direction)
+            child_key = state_key(child)
+            if child_key in parents:
+                continue
+            parents[child_key] = (key, direction)
+
+            if victory:
+                solution = get_path(parents, child_key)
+                break
+            if not child.has_you(lab.parse_rules(child)[0]):
+                continue  # dead state: nothing can move any more
+
+            if heuristic is None:
+                frontier.append((depth + 1, child, child_key))
+            else:
+                priority = depth + 1 + heuristic(child)
+                heapq.heappush(frontier, (priority, next(order), depth + 1, child, child_key))
+
+    return {
+        "solution": solution,
+        "expanded": expanded,
+        "visited": len(parents),
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+class WorkerError(RuntimeError):
+    """
+    Raised by solve_parallel when one of its workers raised, with that
+    worker's traceback as message.
+    """
+
+
+def exchange(index, inboxes, buckets):
+    """
+    All-to-all exchange between the workers of solve_parallel: send
+    buckets[j] to every other worker j through its queue in inboxes, and
+    return the list of the buckets sent to worker index by every worker, in
+    worker order.  A worker's bucket for itself is kept as it is rather than
+    pickled through its own queue.
+    """
+    for other, (inbox, bucket) in enumerate(zip(inboxes, buckets)):
+        if other != index:
+            inbox.put((index, bucket))
+    received = [None] * len(inboxes)
+    received[index] = buckets[index]
+    for _ in range(len(inboxes) - 1):
+        sender, bucket = inboxes[index].get()
+        received[sender] = bucket
+    return received
+
+
+def shard_worker(index, level_description, commands, inboxes, results):
+    """
+    Worker index of solve_parallel, owning the shard of the transposition
+    table (and of the frontier) holding the states whose state hash (the first
+    item of their key, see state_key) is index modulo the number of workers.
+    inboxes holds one list of per-worker queues for each exchange of an
+    expansion, so messages of different exchanges never mix.  Commands (tuples read from commands) are:
+        - ("expand",): expand the frontier, then put (index, states expanded,
+          new frontier size, winning keys, shard size) on results (see below)
+        - ("parent", key): put the (parent key, direction) of key (in this
+          shard) on results, or None for the start state
+        - ("stop",): return
+    If the worker raises, it puts a WorkerError on results and returns.
+
+    An expansion takes three all-to-all exchanges, so that only the boards of
+    new states are ever sent between processes:
+        1. every worker steps its frontier states in every direction and
+           claims each child from its owner, by key (hash and cells, so that
+           boards with the same objects in another order are told apart)
+        2. owners record the children not in their shard yet, and answer each
+           worker with the keys it claimed first
+        3. every worker sends the boards of its accepted children that still
+           have a YOU object to their owners, which make them the new frontier
+    """
+    # the search makes no reference cycles, but keeps so many containers (the
+    # boards' cells) alive that cyclic garbage collection would take half its time
+    gc.disable()
+    try:
+        search_shard(index, level_description, commands, inboxes, results)
+    except Exception:
+        results.put(WorkerError(f"solver worker {index} failed:\n{traceback.format_exc()}"))
+
+
+def search_shard(index, level_description, commands, inboxes, results):
+    """
+    Helper function for shard_worker, running its commands until told to stop.
+    """
+    claims_inboxes, accepted_inboxes, states_inboxes = inboxes
+    shards = len(claims_inboxes)
+    start = lab.new_game(level_description)
+    start_key = state_key(start)
+    parents = {}
+    frontier = []
+    if start_key[0] % shards == index:
+        parents[start_key] = None
+        frontier.append((start_key, start))
+
+    while True:
+        command = commands.get()
+        if command[0] == "stop":
+            return
+        if command[0] == "parent":
+            results.put(parents[command[1]])
+            continue
+
+        # 1. claim every child from its owner
+        children = {}
+        claims = [[] for _ in range(shards)]
+        for key, game in frontier:
+            for direction in DIRECTIONS:
+                child = game.copy()
+                victory = lab.step_game(child, direction)
+                child_key = state_key(child)
+                if child_key in children or (child_key[0] % shards == index and child_key in parents):
+                    continue
+                children[child_key] = child
+                claims[child_key[0] % shards].append((child_key, key, direction, victory))
+
+        # 2. accept the claims of new states
+        wins = []
+        accepted = [[] for _ in range(shards)]
+        for claimant, bucket in enumerate(exchange(index, claims_inboxes, claims)):
+            for child_key, key, direction, victory in bucket:
+                if child_key in parents:
+                    continue
+                parents[child_key] = (key, direction)
+                if victory:
+                    wins.append(child_key)
+                else:
+                    accepted[claimant].append(child_key)
+
+        # 3. hand the accepted live states over to their owners
+        states = [[] for _ in range(shards)]
+        for bucket in exchange(index, accepted_inboxes, accepted):
+            for child_key in bucket:
+                child = children[child_key]
+                if child.has_you(lab.parse_rules(child)[0]):
+                    states[child_key[0] % shards].append((child_key, child))
+
+        expanded = len(frontier)
+        frontier = [state for bucket in exchange(index, states_inboxes, states) for state in bucket]
+        results.put((index, expanded, len(frontier), wins, len(parents)))
+
+
+def solve_parallel(level_description, processes=None, max_nodes=None):
+    """
+    Search for a shortest sequence of directions that wins the given level,
+    breadth-first like solve, but with processes workers (default: one per
+    CPU, see shard_worker) that each own a shard of the transposition table
+    and of the frontier, partitioned by the state hash part of the state keys
+    (see state_key), which owners compare in full.  The search goes one depth
+    at a time: every worker expands its frontier, the children are sent to
+    their owners to be checked against their shards, and the next depth only
+    starts once all of them are done.  max_nodes is only checked between
+    depths.
+
+    Returns a dict like solve, with the number of processes.  Raises
+    WorkerError (after stopping every worker) if a worker raised.
+    """
+    start_time = time.perf_counter()
+    processes = processes or os.cpu_count() or 1
+    commands = [multiprocessing.Queue() for _ in range(processes)]
+    inboxes = [[multiprocessing.Queue() for _ in range(processes)] for _ in range(3)]
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=shard_worker,
+            args=(index, level_description, commands[index], inboxes, results),
+            daemon=True,
+        )
+        for index in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    def get_result():
+        while True:
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in workers):
+                    raise WorkerError("a solver worker died")
+                continue
+            if isinstance(result, WorkerError):
+                raise result
+            return result
+
+    solution = None
+    expanded = 0
+    visited = 1
+    try:
+        frontier = 1
+        while frontier and solution is None:
+            if max_nodes is not None and expanded >= max_nodes:
+                break
+            for worker_commands in commands:
+                worker_commands.put(("expand",))
+            replies = sorted(get_result() for _ in workers)
+            expanded += sum(reply[1] for reply in replies)
+            frontier = sum(reply[2] for reply in replies)
+            wins = [key for reply in replies for key in reply[3]]
+            visited = sum(reply[4] for reply in replies)
+            if wins:
+                # follow the parents links from shard to shard
+                solution = []
+                key = wins[0]
+                while True:
+                    commands[key[0] % processes].put(("parent", key))
+                    parent = get_result()
+                    if parent is None:
+                        break
+                    key, direction = parent
+                    solution.append(direction)
+                solution.reverse()
+    except BaseException:
+        # the other workers may be stuck waiting for the failed one's buckets
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker_commands in commands:
+            worker_commands.put(("stop",))
+        for worker in workers:
+            worker.join()
+
+    return {
+        "solution": solution,
+        "expanded": expanded,
+        "visited": visited,
+        "seconds": time.perf_counter() - start_time,
+        "processes": processes,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("levels", nargs="*", help="level files (default: puzzles/*)")
+    parser.add_argument("--astar", action="store_true", help="order the search by distance to WIN")
+    parser.add_argument("--max-nodes", type=int, default=None, help="give up after this many expansions")
+    parser.add_argument("--show", action="store_true", help="print the solutions")
+    parser.add_argument("--processes", type=int, default=1, help="breadth-first search with this many workers")
+    parsed = parser.parse_args()
+
+    levels = parsed.levels or [
+        os.path.join(server.LOCATION, "puzzles", fname)
+        for fname in sorted(os.listdir(os.path.join(server.LOCATION, "puzzles")))
+    ]
+    heuristic = distance_to_win if parsed.astar else None
+    if heuristic is not None and parsed.processes != 1:
+        parser.error("--astar can't be used with --processes")
+
+    unsolved = 0
+    for level in levels:
+        if parsed.processes == 1:
+            result = solve(server.read_level(level), heuristic, parsed.max_nodes)
+        else:
+            result = solve_parallel(server.read_level(level), parsed.processes, parsed.max_nodes)
+        rate = result["expanded"] / max(result["seconds"], 1e-9)
+        processes = f", {result['processes']} processes" if "processes" in result else ""
+        if result["solution"] is None:
+            unsolved += 1
+            outcome = "no solution found"
+        else:
+            outcome = f"solved in {len(result['solution'])} moves"
+        print(
+            f"{os.path.basename(level)}: {outcome}, {result['expanded']} nodes expanded"
+            f" in {result['seconds']:.2f}s ({rate:.0f} nodes/s{processes})"
+        )
+        if parsed.show and result["solution"] is not None:
+            print("   ", " ".join(result["solution"]))
+
+    sys.exit(1 if unsolved else 0)
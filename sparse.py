@@ -0,0 +1,240 @@
+"""Sparse Board engine for Snek Is You, for huge and mostly empty levels"""
+
+import lab
+
+
+class SparseLevel:
+    '''
+    Level description that only stores the occupied cells, as lists of
+    objects keyed by location (tuple (x,y)), also grouped by row and by column.
+
+    It can be used like a list of lists of lists: level[x][y] is the cell at
+    (x,y) (a new empty list if there's nothing there, so cells can only be
+    added and removed through add_cell and remove_cell), negative indices
+    count from the end and iterating gives every row and cell. That is all
+    lab.Board and lab.decode_level need.
+    '''
+    def __init__(self, rows, cols, cells=()):
+        '''
+        Create a rows x cols level holding cells (dict or iterable of
+        (location, list of objects) pairs); empty cells are left out.
+        '''
+        self.rows = rows
+        self.cols = cols
+        self.cells = {}         # maps a location (x,y) to its non-empty list of objects
+        self.row_cells = {}     # maps x to a dict of {y: cell} of that row's occupied cells
+        self.col_cells = {}     # maps y to a dict of {x: cell} of that column's occupied cells
+        for location, cell in dict(cells).items():
+            if cell:
+                self.add_cell(location).extend(cell)
+
+
+    @classmethod
+    def from_level(cls, level_description):
+        '''
+        Return a SparseLevel holding the objects of level_description (list of
+        lists of lists), with every object replaced by its token.
+        '''
+        return cls(
+            len(level_description),
+            len(level_description[0]),
+            (((x, y), [lab.get_token(obj) for obj in cell])
+             for x, row in enumerate(level_description)
+             for y, cell in enumerate(row) if cell),
+        )
+
+
+    def add_cell(self, location):
+        '''
+        Add an (empty) cell to be filled at location (tuple (x,y)), and return it.
+        '''
+        x, y = location
+        cell = []
+        self.cells[location] = cell
+        self.row_cells.setdefault(x, {})[y] = cell
+        self.col_cells.setdefault(y, {})[x] = cell
+        return cell
+
+
+    def remove_cell(self, location):
+        '''
+        Forget the (emptied) cell at location (tuple (x,y)).
+        '''
+        x, y = location
+        del self.cells[location]
+        del self.row_cells[x][y]
+        if not self.row_cells[x]:
+            del self.row_cells[x]
+        del self.col_cells[y][x]
+        if not self.col_cells[y]:
+            del self.col_cells[y]
+
+
+    def copy(self):
+        '''
+        Return a copy of this level whose cells can be changed independently.
+        '''
+        return SparseLevel(self.rows, self.cols, self.cells)
+
+
+    def __len__(self):
+        return self.rows
+
+
+    def __getitem__(self, x):
+        if x < 0:
+            x += self.rows
+        if not 0 <= x < self.rows:
+            raise IndexError("row index out of range")
+        return SparseRow(self, x)
+
+
+    def __iter__(self):
+        return (SparseRow(self, x) for x in range(self.rows))
+
+
+class SparseRow:
+    '''
+    View of row x of a SparseLevel, indexed and iterated like a list of cells.
+    '''
+    __slots__ = ("level", "x")
+
+    def __init__(self, level, x):
+        self.level = level
+        self.x = x
+
+
+    def __len__(self):
+        return self.level.cols
+
+
+    def __getitem__(self, y):
+        cols = self.level.cols
+        if y < 0:
+            y += cols
+        if not 0 <= y < cols:
+            raise IndexError("column index out of range")
+        cell = self.level.cells.get((self.x, y))
+        return [] if cell is None else cell
+
+
+    def __iter__(self):
+        cells = self.level.row_cells.get(self.x, {})
+        return (cells.get(y, []) for y in range(self.level.cols))
+
+
+def get_line_phrases(line_cells):
+    '''
+    Return the list of possible phrases in a row or column, given as a dict
+    mapping the position along the line to each occupied cell.
+    '''
+    tokens = []
+    previous = None
+    for position in sorted(line_cells):
+        if previous is not None and position != previous + 1:
+            tokens.append(None)     # empty cells in between break the phrase
+        tokens.append(lab.get_phrase_token(line_cells[position]))
+        previous = position
+    return lab.get_token_phrases(tokens)
+
+
+class SparseBoard(lab.Board):
+    '''
+    Board whose level_description is a SparseLevel, so that its memory use
+    and the work done on each step depend on the number of objects rather
+    than on the area of the board. Only dump_game still visits every cell.
+
+    The phrase cache only holds the rows and columns that have (or had)
+    objects in them, as dicts instead of lists.
+    '''
+    def clear_phrases(self):
+        '''
+        Mark every occupied row and column as needing to be scanned for phrases.
+        '''
+        self.row_phrases = dict.fromkeys(self.level_description.row_cells)
+        self.col_phrases = dict.fromkeys(self.level_description.col_cells)
+
+
+    def build_index(self):
+        '''
+        Build the object index (see lab.Board.build_index) from the occupied cells.
+        '''
+        self.locations = {}
+        for location, cell in self.level_description.cells.items():
+            for obj in cell:
+                self.index_add(obj, location)
+
+
+    def compute_hash(self):
+        '''
+        Return the Zobrist hash of the board from scratch (see lab.Board.compute_hash).
+        '''
+        hash_ = 0
+        for (x, y), cell in self.level_description.cells.items():
+            for index, obj in enumerate(cell):
+                hash_ ^= lab.get_zobrist_key(x, y, obj, cell[:index].count(obj))
+        return hash_
+
+
+    def copy_level(self):
+        '''
+        Helper function for copy. Return a copy of the SparseLevel.
+        '''
+        return self.level_description.copy()
+
+
+    def add_obj(self, obj, location, index=None):
+        '''
+        Add obj (token) to the cell at location (tuple (x,y)), see lab.Board.add_obj.
+        '''
+        if location not in self.level_description.cells:
+            self.level_description.add_cell(location)
+        super().add_obj(obj, location, index)
+
+
+    def remove_obj(self, obj, location, index=None):
+        '''
+        Remove obj (token) from the cell at location (tuple (x,y)), see
+        lab.Board.remove_obj.
+        '''
+        super().remove_obj(obj, location, index)
+        if not self.level_description.cells[location]:
+            self.level_description.remove_cell(location)
+
+
+    def get_phrases(self):
+        '''
+        Return the list of unique possible phrases on the board (horizontal ones
+        first, then vertical ones), re-scanning only the rows and columns marked
+        dirty, and forgetting the ones that became empty.
+        '''
+        level = self.level_description
+        for line_phrases, line_cells in ((self.row_phrases, level.row_cells),
+                                         (self.col_phrases, level.col_cells)):
+            for i in [i for i, phrases in line_phrases.items() if phrases is None]:
+                if i in line_cells:
+                    line_phrases[i] = get_line_phrases(line_cells[i])
+                else:
+                    del line_phrases[i]
+
+        # in the same order as lab.Board.get_phrases, since it decides the rules' order
+        return (lab.merge_phrases(self.row_phrases[x] for x in sorted(self.row_phrases))
+                + lab.merge_phrases(self.col_phrases[y] for y in sorted(self.col_phrases)))
+
+
+def new_game(level_description):
+    """
+    Given a description of a game state (a list of lists of lists, see
+    lab.new_game, or a SparseLevel), create and return a SparseBoard
+    instance that contains it.
+    """
+    if isinstance(level_description, SparseLevel):
+        level_description = SparseLevel(
+            level_description.rows,
+            level_description.cols,
+            ((location, [lab.get_token(obj) for obj in cell])
+             for location, cell in level_description.cells.items()),
+        )
+    else:
+        level_description = SparseLevel.from_level(level_description)
+    return SparseBoard(level_description)
@@ -4,6 +4,7 @@ import sys
 import copy
 import json
 import pickle
+import threading
 
 import lab
 
@@ -40,16 +41,45 @@ def compare_boards(your_board, expected_board, step_num):
             ), f"objects at location ({rn},{cn}) don't match on step {step_num}"
 
 
-def compare_simulation(filename):
-    with open(os.path.join(TEST_DIRECTORY, "test_levels", f"{filename}.json")) as f:
+def load_case(name):
+    """
+    Return (level description, list of directions) of the test case name.
+    """
+    with open(os.path.join(TEST_DIRECTORY, "test_levels", f"{name}.json")) as f:
         level = json.load(f)
-    with open(os.path.join(TEST_DIRECTORY, "test_inputs", f"{filename}.txt")) as f:
+    with open(os.path.join(TEST_DIRECTORY, "test_inputs", f"{name}.txt")) as f:
         inputs = f.read().strip().splitlines(False)
-    with open(os.path.join(TEST_DIRECTORY, "test_outputs", f"{filename}.json")) as f:
-        outputs = json.load(f)
+    return level, inputs
+
+
+def load_outputs(name):
+    """
+    Return the expected (board, victory) after each step of the test case name.
+    """
+    with open(os.path.join(TEST_DIRECTORY, "test_outputs", f"{name}.json")) as f:
+        return json.load(f)
+
+
+def compare_simulation(filename, new_game=lab.new_game):
+    level, inputs = load_case(filename)
+
+    # compact goldens (see golden.py) are streamed instead of loaded whole
+    import golden
+
+    golden_path = golden.find_golden(os.path.join(TEST_DIRECTORY, "test_outputs"), filename)
+    if golden_path is not None:
+        for flip in (False, True):
+            level_ = flip_board(level) if flip else level
+            inputs_ = [flip_direction[direction] for direction in inputs] if flip else inputs
+            game = new_game(level_)
+            compare_boards(lab.dump_game(game), level_, 0)
+            assert golden.compare_golden(game, inputs_, golden.read_golden(golden_path), flip) == len(inputs) != 0
+        return
+
+    outputs = load_outputs(filename)
     assert len(inputs) == len(outputs) != 0
 
-    game = lab.new_game(copy.deepcopy(level))
+    game = new_game(copy.deepcopy(level))
     compare_boards(lab.dump_game(game), level, 0)
     for ix, (direction, (exp_dump, exp_win)) in enumerate(zip(inputs, outputs)):
         victory = lab.step_game(game, direction)
@@ -58,7 +88,7 @@ def compare_simulation(filename):
 
     # trip to flip x,y for everything
     level2 = flip_board(level)
-    game = lab.new_game(copy.deepcopy(level2))
+    game = new_game(copy.deepcopy(level2))
     compare_boards(lab.dump_game(game), level2, 0)
     for ix, (direction, (exp_dump, exp_win)) in enumerate(zip(inputs, outputs)):
         victory = lab.step_game(game, flip_direction[direction])
@@ -77,6 +107,523 @@ def test_simulation(sim):
     compare_simulation(sim)
 
 
+def test_move_order():
+    # YOU objects move one type at a time, each type from where the previous
+    # ones left it: the snek pushes the rock, which then moves on its own
+    level = [
+        [["SNEK"], ["IS"], ["YOU"], [], [], []],
+        [["ROCK"], ["IS"], ["YOU"], ["AND"], ["PUSH"], []],
+        [[], [], [], [], [], []],
+        [["snek"], ["rock"], [], [], [], []],
+    ]
+    game = lab.new_game(level)
+    assert not lab.step_game(game, "right")
+    assert lab.dump_game(game)[3] == [[], ["snek"], [], ["rock"], [], []]
+
+
+@pytest.mark.parametrize("sim", test_cases)
+def test_step_game_many(sim):
+    level, inputs = load_case(sim)
+
+    game = lab.new_game(copy.deepcopy(level))
+    victory, steps = lab.step_game_many(game, inputs)
+    assert 1 <= steps <= len(inputs)
+
+    # must match stepping one direction at a time up to where it stopped
+    expected = lab.new_game(copy.deepcopy(level))
+    for direction in inputs[:steps]:
+        expected_victory = lab.step_game(expected, direction)
+    assert victory == expected_victory
+    compare_boards(lab.dump_game(game), lab.dump_game(expected), steps)
+    if steps < len(inputs):
+        assert victory or not game.has_you(lab.parse_rules(game)[0])
+
+
+@pytest.mark.parametrize("sim", test_cases)
+def test_dump_changes(sim):
+    level, inputs = load_case(sim)
+
+    # patching the previous dump with the changes must give the new dump
+    game = lab.new_game(copy.deepcopy(level))
+    assert lab.dump_changes(game) == []
+    board = lab.dump_game(game)
+    for ix, direction in enumerate(inputs):
+        lab.step_game(game, direction)
+        for row, col, cell in lab.dump_changes(game):
+            board[row][col] = cell
+        assert board == lab.dump_game(game), f"changes don't match on step {ix + 1}"
+
+
+@pytest.mark.parametrize("sim", test_cases)
+def test_state_hash(sim):
+    level, inputs = load_case(sim)
+
+    # the incrementally updated hash must match one computed from scratch,
+    # and only depend on which objects are in which cells (so it isn't a state
+    # identity: the order of objects in a cell matters to pushing)
+    game = lab.new_game(copy.deepcopy(level))
+    for ix, direction in enumerate(inputs):
+        lab.step_game(game, direction)
+        assert game.state_hash() == game.compute_hash(), f"stale hash on step {ix + 1}"
+        reordered = [[cell[::-1] for cell in row] for row in lab.dump_game(game)]
+        assert game.state_hash() == lab.new_game(reordered).state_hash()
+
+
+def test_state_hash_same_noun():
+    # an X IS X rule replaces every X with itself, which must change nothing
+    game = lab.new_game([[["SNEK"], ["IS"], ["SNEK"]], [["snek"], [], []]])
+    lab.dump_changes(game)
+    lab.step_game(game, "right")
+    assert game.state_hash() == game.compute_hash()
+    assert lab.dump_changes(game) == []
+
+
+@pytest.mark.parametrize("sim", test_cases)
+def test_undo_step(sim):
+    level, inputs = load_case(sim)
+
+    # undoing every step must give back each earlier board exactly, in reverse
+    game = lab.new_game(copy.deepcopy(level))
+    game.start_journal()
+    history = [(lab.dump_game(game), game.state_hash())]
+    for direction in inputs:
+        lab.step_game(game, direction)
+        history.append((lab.dump_game(game), game.state_hash()))
+    for ix in range(len(inputs), 0, -1):
+        assert game.undo_step() is not None
+        assert (lab.dump_game(game), game.state_hash()) == history[ix - 1], f"undo of step {ix} doesn't match"
+    assert game.undo_step() is None
+
+    # and stepping again from there must behave like a fresh game
+    victory = lab.step_game(game, inputs[0])
+    expected = lab.new_game(copy.deepcopy(level))
+    assert victory == lab.step_game(expected, inputs[0])
+    assert lab.dump_game(game) == lab.dump_game(expected)
+
+
+def test_history(monkeypatch):
+    import server
+
+    # small checkpoint interval and cap so undo also goes through snapshots
+    monkeypatch.setattr(server, "HISTORY_CHECKPOINT_INTERVAL", 3)
+    monkeypatch.setattr(server, "HISTORY_MAX_CELLS", 100)
+    level, inputs = load_case("16_little_snek")
+
+    game = lab.new_game(copy.deepcopy(level))
+    history = server.History(game)
+    boards = [lab.dump_game(game)]
+    for direction in inputs:
+        history.step(game, [direction])
+        boards.append(lab.dump_game(game))
+    assert sum(size for _, size in history.checkpoints.values()) <= 100
+
+    for ix in range(len(inputs) - 1, -1, -1):
+        game, _ = history.undo(game)
+        assert lab.dump_game(game) == boards[ix], f"undo to step {ix} doesn't match"
+    for ix in range(1, len(inputs) + 1):
+        history.redo(game)
+        assert lab.dump_game(game) == boards[ix], f"redo of step {ix} doesn't match"
+
+
+def request(path, params):
+    import io
+    import server
+
+    body = json.dumps(params).encode("utf-8")
+    environ = {"PATH_INFO": path, "CONTENT_LENGTH": str(len(body)), "wsgi.input": io.BytesIO(body)}
+    return b"".join(server.application(environ, lambda status, headers: None))
+
+
+def test_level_cache(monkeypatch, tmp_path):
+    import server
+
+    monkeypatch.setattr(server, "LOCATION", str(tmp_path))
+    monkeypatch.setattr(server, "LEVEL_CATALOG", (None, []))
+    for directory in server.LEVEL_DIRECTORIES:
+        (tmp_path / directory).mkdir()
+    path = tmp_path / "puzzles" / "tiny.json"
+    path.write_text(json.dumps([[["snek"], []]]))
+
+    # levels are parsed again only once their file changes
+    level = server.load_level("puzzles", "tiny.json")
+    assert server.load_level("puzzles", "tiny.json") is level
+    path.write_text(json.dumps([[[], ["snek"]]]))
+    os.utime(path, (0, 0))
+    assert lab.decode_level(server.load_level("puzzles", "tiny.json")) == [[[], ["snek"]]]
+
+    # so is the catalog, once a level directory changes
+    assert server.get_levels({}) == ["puzzles/tiny.json"]
+    (tmp_path / "test_levels" / "other.txt").write_text("s\n")
+    os.utime(tmp_path / "test_levels", (0, 0))
+    assert server.get_levels({}) == ["puzzles/tiny.json", "test_levels/other.txt"]
+
+    # and lab is only reloaded once its source changes
+    reloads = []
+    monkeypatch.setattr(server.importlib, "reload", reloads.append)
+    server.reload_lab()
+    assert reloads == []
+    monkeypatch.setattr(server, "LAB_MTIME", 0)
+    server.reload_lab()
+    server.reload_lab()
+    assert reloads == [lab] and server.LEVEL_CACHE == {}
+
+    # which ends the games in progress, once the steps being played are done
+    session_id = server.open_session(lab.new_game(level))
+    with server.locked_session({"session": session_id}) as session:
+        monkeypatch.setattr(server, "LAB_MTIME", 0)
+        reloader = threading.Thread(target=server.reload_lab)
+        reloader.start()
+        reloader.join(0.1)
+        assert reloader.is_alive() and reloads == [lab]
+    reloader.join()
+    assert reloads == [lab, lab] and session.closed and session_id not in server.SESSIONS
+    with pytest.raises(KeyError):
+        with server.locked_session({"session": session_id}):
+            pass
+
+
+def test_metrics():
+    session = json.loads(request("/new_game", {"directory": "puzzles", "level": "open.txt"}))["session"]
+    for direction in ["up", "left", "down"]:
+        request("/step_game", {"direction": direction, "session": session})
+    metrics = request("/metrics", {}).decode("utf-8").splitlines()
+
+    counts = dict(line.rsplit(" ", 1) for line in metrics if not line.startswith("#"))
+    assert int(counts['snek_requests_total{endpoint="step_game",status="200"}']) >= 3
+    assert counts['snek_request_duration_seconds_bucket{endpoint="step_game",le="+Inf"}'] == counts['snek_request_duration_seconds_count{endpoint="step_game"}']
+    assert int(counts['snek_response_bytes_total{endpoint="new_game"}']) > 0
+    assert int(counts["snek_active_games"]) >= 1
+
+
+def test_profile(monkeypatch, tmp_path):
+    import server
+
+    monkeypatch.setattr(server, "PROFILE_DIRECTORY", str(tmp_path))
+    session = json.loads(request("/new_game", {"directory": "puzzles", "level": "open.txt"}))["session"]
+    request("/profile", {"session": session, "action": "start", "first": 2, "last": 3})
+    for direction in ["up", "left", "down", "right"]:
+        request("/step_game", {"direction": direction, "session": session})
+
+    # only steps 2 and 3 are profiled
+    result = json.loads(request("/profile", {"session": session, "action": "stop", "limit": 50}))
+    assert result["steps"] == 2 and not result["profiling"]
+    assert os.path.exists(result["file"])
+    functions = {function["function"].rsplit("(", 1)[1][:-1]: function for function in result["functions"]}
+    assert functions["step_game"]["calls"] == 2
+    assert json.loads(request("/profile", {"session": session})) == {"profiling": False}
+
+    # games profiled at the same time take turns, rather than enabling two profilers at once
+    import threading
+
+    sessions = [json.loads(request("/new_game", {"directory": "puzzles", "level": "open.txt"}))["session"] for _ in range(4)]
+    for session in sessions:
+        request("/profile", {"session": session, "action": "start"})
+    responses = []
+    def play(session):
+        for direction in ["up", "left", "down", "right"] * 5:
+            responses.append(json.loads(request("/step_game", {"direction": direction, "session": session})))
+    threads = [threading.Thread(target=play, args=(session,)) for session in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(responses) == 80
+    for session in sessions:
+        assert json.loads(request("/profile", {"session": session, "action": "stop"}))["steps"] == 20
+
+
+@pytest.mark.parametrize("sim", ["10_choo_choo", "16_little_snek", "29_open_stress_test"])
+def test_replay(sim, tmp_path):
+    import replay
+
+    level, inputs = load_case(sim)
+
+    game = lab.new_game(copy.deepcopy(level))
+    expected = [(lab.dump_game(game), False)]
+    for direction in inputs:
+        victory = lab.step_game(game, direction)
+        expected.append((lab.dump_game(game), victory))
+
+    path = str(tmp_path / "replay.json.gz")
+    replay.save_replay(replay.record(level, inputs, interval=4), path)
+    loaded = replay.load_replay(path)
+    assert len(loaded) == len(inputs)
+    for step in [0, 1, 3, 4, 5, len(inputs) // 2, len(inputs)]:
+        game, victory = loaded.seek(step)
+        assert (lab.dump_game(game), victory) == expected[step], f"seek to step {step} doesn't match"
+
+    frames = [(step, lab.dump_game(game), victory) for step, victory, game in loaded.frames(2, 9)]
+    assert frames == [(step, *expected[step]) for step in range(2, min(9, len(inputs) + 1))]
+
+
+@pytest.mark.parametrize("sim", ["10_choo_choo", "16_little_snek", "31_puzzle_time_1"])
+def test_golden(sim, tmp_path):
+    import golden
+
+    level, inputs = load_case(sim)
+    outputs = load_outputs(sim)
+
+    path = str(tmp_path / f"{sim}.golden.gz")
+    golden.write_golden(path, level, outputs)
+    assert golden.find_golden(str(tmp_path), sim) == path
+    assert golden.compare_golden(lab.new_game(level), inputs, golden.read_golden(path)) == len(inputs)
+    flipped = [flip_direction[direction] for direction in inputs]
+    assert golden.compare_golden(lab.new_game(flip_board(level)), flipped, golden.read_golden(path), flip=True) == len(inputs)
+
+    # the comparison stops at the first step that doesn't match
+    records = list(golden.read_golden(path))
+    step = next(step for step, record in enumerate(records[1:], 1) if record["changes"])
+    x, y, cell = records[step]["changes"][0]
+    records[step]["changes"][0] = [x, y, cell + ["rock"]]
+    with pytest.raises(AssertionError, match=f"on step {step}$"):
+        golden.compare_golden(lab.new_game(level), inputs, iter(records))
+
+
+def test_runner():
+    import runner
+
+    jobs = runner.get_jobs([], [])[:8]
+    results = list(runner.run_jobs(jobs, processes=2, chunksize=3))
+    assert [(result["level"], result["inputs"]) for result in results] == jobs
+    for result, (level_path, inputs_path) in zip(results, jobs):
+        with open(level_path) as f:
+            game = lab.new_game(json.load(f))
+        with open(inputs_path) as f:
+            inputs = f.read().strip().splitlines(False)
+        wins = [lab.step_game(game, direction) for direction in inputs[: result["steps"]]]
+        assert result["outcome"] == ("win" if wins[-1] else "defeat" if not game.has_you(lab.parse_rules(game)[0]) else "none")
+        assert True not in wins[:-1]
+        assert result["state_hash"] == f"{game.state_hash():016x}"
+
+
+def test_hints():
+    import hints
+
+    level = [
+        [["snek"], [], ["wall"], ["flag"]],
+        [[], [], [], []],
+        [["SNEK"], ["IS"], ["YOU"], []],
+        [["FLAG"], ["IS"], ["WIN"], []],
+        [["WALL"], ["IS"], ["STOP"], []],
+    ]
+    game = lab.new_game(level)
+    assert hints.get_hints(game) == [{"object": "snek", "location": [0, 0], "distance": 5, "direction": "down"}]
+    # the field is cached until the layout changes
+    assert hints.get_distances(game) is hints.get_distances(game)
+    lab.step_game(game, "right")
+    assert hints.get_hints(game) == [{"object": "snek", "location": [0, 1], "distance": 4, "direction": "down"}]
+    assert hints.get_distances(game) is hints.get_distances(lab.new_game(level))
+    # the layout key comes from hashes of where objects are, kept up to date as they move
+    fresh = lab.new_game(lab.dump_game(game))
+    assert all(game.objects_hash([obj]) == fresh.objects_hash([obj]) for obj in set(game.object_hashes) | set(fresh.object_hashes))
+
+    # without WALL IS STOP, the wall no longer stands in the way
+    level[4][0] = []
+    game = lab.new_game(level)
+    assert hints.get_hints(game) == [{"object": "snek", "location": [0, 0], "distance": 3, "direction": "right"}]
+
+    session = json.loads(request("/new_game", {"directory": "puzzles", "level": "open.txt"}))["session"]
+    hints_ = json.loads(request("/hint", {"session": session}))["hints"]
+    assert hints_ == [{"object": "snek", "location": [6, 4], "distance": 7, "direction": "right"}]
+
+
+def test_hints_bitboard():
+    pytest.importorskip("numpy")
+    import hints
+    import bitboard
+    import server
+
+    level = server.read_level(os.path.join(TEST_DIRECTORY, "puzzles", "open.txt"))
+    assert hints.get_hints(bitboard.new_game(level)) == hints.get_hints(lab.new_game(level))
+
+
+def test_solver():
+    import server
+    import solver
+
+    level = server.read_level(os.path.join(TEST_DIRECTORY, "puzzles", "open.txt"))
+    result = solver.solve(level)
+    assert len(result["solution"]) == 7
+
+    # replaying the solution must win, on its last move only
+    game = lab.new_game(level)
+    wins = [lab.step_game(game, direction) for direction in result["solution"]]
+    assert wins == [False] * 6 + [True]
+
+    astar = solver.solve(level, solver.distance_to_win)
+    assert astar["expanded"] <= result["expanded"]
+
+    # boards with the same objects in a different order within a cell share a
+    # state hash, but not a state: only the last object in a cell decides pushes
+    def cell_order_level(cell):
+        return [
+            [["SNEK"], ["IS"], ["YOU"], [], []],
+            [["ROCK"], ["IS"], ["PUSH"], [], []],
+            [["snek"], cell, ["rock"], [], []],
+        ]
+    first, second = lab.new_game(cell_order_level(["rock", "bug"])), lab.new_game(cell_order_level(["bug", "rock"]))
+    assert first.state_hash() == second.state_hash()
+    assert solver.state_key(first) != solver.state_key(second)
+    lab.step_game(first, "right")
+    lab.step_game(second, "right")
+    assert lab.dump_game(first) != lab.dump_game(second)
+
+    # walled in, snek and bug (both YOU) can end up in the same cell in either
+    # order, which are different states: both searches must see all 7 of them
+    walled = [
+        [["SNEK"], ["IS"], ["YOU"], ["wall"], ["wall"]],
+        [["BUG"], ["IS"], ["YOU"], ["wall"], ["wall"]],
+        [["WALL"], ["IS"], ["STOP"], ["wall"], ["wall"]],
+        [["wall"], ["snek"], [], ["bug"], ["wall"]],
+        [["wall"], ["wall"], ["wall"], ["wall"], ["wall"]],
+    ]
+    exhaustive = solver.solve(walled)
+    assert exhaustive["solution"] is None and exhaustive["visited"] == 7
+    assert solver.solve_parallel(walled, processes=3)["visited"] == 7
+
+    # the states are sharded between the processes, but the search is still breadth-first
+    parallel = solver.solve_parallel(level, processes=3)
+    assert len(parallel["solution"]) == 7
+    game = lab.new_game(level)
+    assert [lab.step_game(game, direction) for direction in parallel["solution"]] == [False] * 6 + [True]
+
+    # an error in one worker stops them all (the engine raises ValueError in some states of this level)
+    level, _ = load_case("41_and_is_and")
+    with pytest.raises(ValueError):
+        solver.solve(level)
+    with pytest.raises(solver.WorkerError, match="ValueError"):
+        solver.solve_parallel(level, processes=3)
+
+
+def test_stats():
+    level, inputs = load_case("08_pull_scenarios")
+
+    events = []
+    game = lab.new_game(copy.deepcopy(level))
+    game.stats = lab.Stats(lambda name, value: events.append(name))
+    for direction in inputs:
+        lab.step_game(game, direction)
+
+    # instrumenting must not change the game
+    expected = lab.new_game(copy.deepcopy(level))
+    for direction in inputs:
+        lab.step_game(expected, direction)
+    assert lab.dump_game(game) == lab.dump_game(expected)
+
+    stats = game.stats.as_dict()
+    assert stats["steps"] == len(inputs)
+    assert events.count("move") == len(inputs)
+    assert events.count("parse_rules") == 2 * len(inputs)
+    assert set(stats["seconds"]) == set(lab.Stats.PHASES)
+    assert "pull_chain" in stats["events"] and "phrases" in stats["events"]
+    json.dumps(stats)
+
+
+def test_bench():
+    import bench
+
+    level = [[["snek"], []], [["SNEK"], ["IS"]], [["YOU"], []]]
+    tiled = bench.tile_level(level, 7, 5)
+    assert len(tiled) == 7 and all(len(row) == 5 for row in tiled)
+    assert tiled[3][2] == level[0][0] and tiled[3][2] is not level[0][0]
+
+    # the timed steps must end where lab.step_game would
+    directions = ["right", "down", "left", "up"]
+    result = bench.run_scenario(lab.new_game, tiled, directions)
+    expected = lab.new_game(tiled)
+    for direction in directions:
+        lab.step_game(expected, direction)
+    assert result["state_hash"] == expected.state_hash()
+    assert set(result["phases"]) == set(lab.Stats.PHASES)
+    assert result["steps"] == 4 and result["peak_memory_bytes"] > 0
+
+
+@pytest.mark.parametrize("sim", test_cases)
+def test_simulation_bitboard(sim):
+    pytest.importorskip("numpy")
+    import bitboard
+
+    compare_simulation(sim, bitboard.new_game)
+
+
+def test_bitboard_planes(monkeypatch):
+    pytest.importorskip("numpy")
+    import bitboard
+
+    # the planes and phrase codes follow the cells as objects move
+    level = [
+        [["SNEK"], ["IS"], ["YOU"], []],
+        [["snek"], ["flag"], [], []],
+        [["FLAG"], ["IS"], ["WIN"], []],
+    ]
+    game = bitboard.new_game(level)
+    for direction in ["right", "down", "up", "left"]:
+        lab.step_game(game, direction)
+    expected = bitboard.new_game(lab.dump_game(game))
+    assert (game.planes == expected.planes).all() and (game.codes == expected.codes).all()
+
+    # counts that don't fit in the planes are an error rather than wrapping around
+    monkeypatch.setattr(bitboard, "COUNT_MAX", 3)
+    with pytest.raises(OverflowError):
+        bitboard.new_game([[["rock"] * 4]])
+
+
+def test_batch():
+    np = pytest.importorskip("numpy")
+    import batch
+    import server
+
+    level = server.read_level(os.path.join(TEST_DIRECTORY, "puzzles", "open.txt"))
+    moves = np.random.default_rng(6009).integers(0, 4, size=(20, 100))
+    moves[:, 0] = -1  # game 0 never moves
+    games = batch.BatchGame(level, 100)
+    games.run(moves)
+    assert games.distinct_states() < 100
+
+    # every game must end up where stepping it on its own would
+    for i in range(100):
+        game = lab.new_game(level)
+        victory, steps = lab.step_game_many(game, [batch.DIRECTIONS[move] for move in moves[:, i] if move >= 0])
+        assert games.steps[i] == steps
+        assert games.won[i] == victory
+        assert games.defeated[i] == (not victory and not game.has_you(lab.parse_rules(game)[0]))
+        assert games.dump_game(i) == lab.dump_game(game)
+    assert games.steps[0] == 0 and games.won.any()
+
+
+@pytest.mark.parametrize("sim", test_cases)
+def test_simulation_sparse(sim):
+    import sparse
+
+    compare_simulation(sim, sparse.new_game)
+
+
+def test_sparse_level():
+    import server
+    import sparse
+
+    with open(os.path.join(TEST_DIRECTORY, "puzzles", "open.txt")) as f:
+        text = f.read()
+    level = server.parse_ascii_level(text, sparse_level=True)
+    assert isinstance(level, sparse.SparseLevel)
+    assert len(level.cells) == sum(map(bool, text.replace(".", "").replace("\n", "")))
+
+    # same game as the dense level, with only the occupied cells stored
+    game = sparse.new_game(level)
+    expected = lab.new_game(server.parse_ascii_level(text))
+    assert lab.dump_game(game) == lab.dump_game(expected)
+    assert game.state_hash() == expected.state_hash()
+    for direction in ["up", "left", "left", "down", "right"]:
+        assert lab.step_game(game, direction) == lab.step_game(expected, direction)
+        assert lab.dump_game(game) == lab.dump_game(expected)
+        assert game.state_hash() == expected.state_hash()
+    assert all(game.level_description.cells.values())
+
+    copied = game.copy()
+    lab.step_game(copied, "up")
+    assert lab.dump_game(game) == lab.dump_game(expected)
+
+
 if __name__ == "__main__":
     import os
     import sys